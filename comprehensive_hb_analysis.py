@@ -5,6 +5,12 @@ from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from openpyxl.utils.dataframe import dataframe_to_rows
 from openpyxl.utils import get_column_letter
 from openpyxl.chart import BarChart, PieChart, Reference
+from hb_data import load_bookings
+from hb_cube import load_cube, rollup, with_ratios
+from hb_metrics import TACTIC_RULES, agency_metrics, opportunity_scores, top_k
+from hb_stats import simulate_uplift
+from hb_concentration import gini, hhi, labels_for_share, pareto, top_share
+from hb_sketch import distinct_count, load_distinct_sketch
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -12,12 +18,12 @@ print("="*80)
 print("COMPREHENSIVE HALF BOARD DEEP-DIVE ANALYSIS")
 print("="*80)
 
-# Read the data
-df = pd.read_excel('/home/gee_devops254/Downloads/Half Board/Half Board.xlsx')
-
-# Data preparation
-df['Avg_Rate_Per_Night'] = df['Room Revenue'] / df['Room Nights']
-df['Has_HB'] = df['Product (Descriptions)'].str.contains('Halfboard|Half Board', case=False, na=False)
+# Read the data (Has_HB, Avg_Rate_Per_Night and Market_Segment come precomputed)
+df = load_bookings()
+# Additive sums by agency, rate code, HB flag, market and booking size
+cube = load_cube()
+# Mergeable distinct-count sketches of agencies and rate codes by the other dimensions
+distinct = load_distinct_sketch()
 
 print(f"\nTotal records: {len(df)}")
 print(f"Records with HB: {df['Has_HB'].sum()}")
@@ -60,6 +66,8 @@ exec_summary['Metric'].extend([
 
 df_hb = df[df['Has_HB']]
 df_non_hb = df[~df['Has_HB']]
+agency_count = distinct_count(distinct, 'Search Name')
+hb_agency_count = distinct_count(distinct[distinct['Has_HB']], 'Search Name')
 
 exec_summary['Value'].extend([
     len(df),
@@ -76,9 +84,9 @@ exec_summary['Value'].extend([
     f"{df_hb['Room Revenue'].sum()/df['Room Revenue'].sum()*100:.1f}%",
     f"{df_hb['Room Nights'].sum()/df['Room Nights'].sum()*100:.1f}%",
     '',
-    df['Search Name'].nunique(),
-    df_hb['Search Name'].nunique(),
-    df['Search Name'].nunique() - df_hb['Search Name'].nunique(),
+    agency_count,
+    hb_agency_count,
+    agency_count - hb_agency_count,
     '',
     f"{df['Room Nights'].mean():.1f} nights",
     f"{df_hb['Room Nights'].mean():.1f} nights",
@@ -109,6 +117,32 @@ exec_summary['Notes'].extend([
     'Non-HB booking average length',
 ])
 
+# Concentration of HB revenue across agencies, from sorted prefix sums
+hb_revenue_pareto = pareto(rollup(cube[cube['Has_HB']], 'Search Name')['Room Revenue'])
+# Concentration ratios are undefined without any HB revenue
+has_hb_revenue = hb_revenue_pareto['Value'].sum() > 0
+exec_summary['Metric'].extend([
+    '',
+    'Agencies for 80% of HB Revenue',
+    'Top 5 Agencies Share of HB Revenue (%)',
+    'HB Revenue Gini',
+    'HB Revenue HHI',
+])
+exec_summary['Value'].extend([
+    '',
+    labels_for_share(hb_revenue_pareto, 0.8),
+    f"{top_share(hb_revenue_pareto, 5)*100:.1f}%" if has_hb_revenue else 'n/a',
+    f"{gini(hb_revenue_pareto):.3f}" if has_hb_revenue else 'n/a',
+    f"{hhi(hb_revenue_pareto):,.0f}" if has_hb_revenue else 'n/a',
+])
+exec_summary['Notes'].extend([
+    '',
+    f"Out of {len(hb_revenue_pareto)} agencies with HB revenue",
+    'Share held by the five largest HB agencies',
+    '0 = evenly spread, towards 1 = one agency',
+    'Above 2,500 is highly concentrated',
+])
+
 df_exec = pd.DataFrame(exec_summary)
 
 # ============================================================================
@@ -116,39 +150,26 @@ df_exec = pd.DataFrame(exec_summary)
 # ============================================================================
 print("[2/9] Building Agency Deep Dive Analysis...")
 
-# Calculate comprehensive agency metrics
-agency_analysis = []
-
-for agency in df['Search Name'].dropna().unique():
-    agency_data = df[df['Search Name'] == agency]
-    agency_hb = agency_data[agency_data['Has_HB']]
-
-    total_nights = agency_data['Room Nights'].sum()
-    hb_nights = agency_hb['Room Nights'].sum()
-
-    analysis = {
-        'Agency Name': agency,
-        'Total Room Nights': total_nights,
-        'HB Room Nights': hb_nights,
-        'Non-HB Room Nights': total_nights - hb_nights,
-        '% HB Nights': (hb_nights / total_nights * 100) if total_nights > 0 else 0,
-        'Total Revenue (AED)': agency_data['Room Revenue'].sum(),
-        'HB Revenue (AED)': agency_hb['Room Revenue'].sum(),
-        'Non-HB Revenue (AED)': agency_data[~agency_data['Has_HB']]['Room Revenue'].sum(),
-        '% HB Revenue': (agency_hb['Room Revenue'].sum() / agency_data['Room Revenue'].sum() * 100) if agency_data['Room Revenue'].sum() > 0 else 0,
-        'Total Bookings': len(agency_data),
-        'HB Bookings': len(agency_hb),
-        'Avg Length of Stay (Overall)': agency_data['Room Nights'].mean(),
-        'Avg Length of Stay (HB)': agency_hb['Room Nights'].mean() if len(agency_hb) > 0 else 0,
-        'Avg Length of Stay (Non-HB)': agency_data[~agency_data['Has_HB']]['Room Nights'].mean() if len(agency_data[~agency_data['Has_HB']]) > 0 else 0,
-        'Avg Rate (Overall) AED': agency_data['Avg_Rate_Per_Night'].mean(),
-        'Avg Rate (HB) AED': agency_hb['Avg_Rate_Per_Night'].mean() if len(agency_hb) > 0 else 0,
-        'Avg Rate (Non-HB) AED': agency_data[~agency_data['Has_HB']]['Avg_Rate_Per_Night'].mean() if len(agency_data[~agency_data['Has_HB']]) > 0 else 0,
-        'Top Rate Code': agency_data['Rate Code'].mode()[0] if len(agency_data['Rate Code'].mode()) > 0 else 'N/A',
-    }
-    agency_analysis.append(analysis)
-
-df_agency = pd.DataFrame(agency_analysis)
+# Calculate comprehensive agency metrics in one grouped pass
+df_agency = agency_metrics(df)[[
+    'Total Room Nights',
+    'HB Room Nights',
+    'Non-HB Room Nights',
+    '% HB Nights',
+    'Total Revenue (AED)',
+    'HB Revenue (AED)',
+    'Non-HB Revenue (AED)',
+    '% HB Revenue',
+    'Total Bookings',
+    'HB Bookings',
+    'Avg Length of Stay (Overall)',
+    'Avg Length of Stay (HB)',
+    'Avg Length of Stay (Non-HB)',
+    'Avg Rate (Overall) AED',
+    'Avg Rate (HB) AED',
+    'Avg Rate (Non-HB) AED',
+    'Top Rate Code',
+]].rename_axis('Agency Name').reset_index()
 df_agency = df_agency.sort_values('Total Revenue (AED)', ascending=False).reset_index(drop=True)
 df_agency.index = df_agency.index + 1  # Start ranking from 1
 
@@ -184,7 +205,7 @@ miracle_los_analysis['Avg Revenue per Booking'] = (miracle_los_analysis['Revenue
 miracle_los_analysis = miracle_los_analysis.reset_index()
 
 # Miracle rate code analysis
-miracle_rate_analysis = miracle_data.groupby(['Rate Code', 'Has_HB']).agg({
+miracle_rate_analysis = miracle_data.groupby(['Rate Code', 'Has_HB'], observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum'
 }).round(2).reset_index()
@@ -269,29 +290,29 @@ for code in universal_codes:
         'Avg LOS (HB)': code_hb['Room Nights'].mean() if len(code_hb) > 0 else 0,
         'Avg Rate (Overall) AED': code_data['Avg_Rate_Per_Night'].mean(),
         'Avg Rate (HB) AED': code_hb['Avg_Rate_Per_Night'].mean() if len(code_hb) > 0 else 0,
-        'Number of Agencies Using': code_data['Search Name'].nunique(),
-        'Top Agency': code_data.groupby('Search Name')['Room Revenue'].sum().idxmax(),
+        'Number of Agencies Using': distinct_count(distinct[distinct['Rate Code'] == code], 'Search Name'),
+        'Top Agency': code_data.groupby('Search Name', observed=True)['Room Revenue'].sum().idxmax(),
     }
     universal_analysis.append(analysis)
 
 # Agency breakdown for each universal code
-tobbwi_agencies = df[df['Rate Code'] == 'TOBBWI'].groupby('Search Name').agg({
+tobbwi_agencies = df[df['Rate Code'] == 'TOBBWI'].groupby('Search Name', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum',
     'Has_HB': 'sum'
 }).round(2).reset_index()
 tobbwi_agencies.columns = ['Agency', 'Room Nights', 'Revenue (AED)', 'HB Bookings']
-tobbwi_agencies['% HB'] = (tobbwi_agencies['HB Bookings'] / df[df['Rate Code'] == 'TOBBWI'].groupby('Search Name').size().values * 100).round(1)
-tobbwi_agencies = tobbwi_agencies.sort_values('Revenue (AED)', ascending=False).head(15)
+tobbwi_agencies['% HB'] = (tobbwi_agencies['HB Bookings'] / df[df['Rate Code'] == 'TOBBWI'].groupby('Search Name', observed=True).size().values * 100).round(1)
+tobbwi_agencies = top_k(tobbwi_agencies, 15, 'Revenue (AED)')
 
-tobbjn_agencies = df[df['Rate Code'] == 'TOBBJN'].groupby('Search Name').agg({
+tobbjn_agencies = df[df['Rate Code'] == 'TOBBJN'].groupby('Search Name', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum',
     'Has_HB': 'sum'
 }).round(2).reset_index()
 tobbjn_agencies.columns = ['Agency', 'Room Nights', 'Revenue (AED)', 'HB Bookings']
-tobbjn_agencies['% HB'] = (tobbjn_agencies['HB Bookings'] / df[df['Rate Code'] == 'TOBBJN'].groupby('Search Name').size().values * 100).round(1)
-tobbjn_agencies = tobbjn_agencies.sort_values('Revenue (AED)', ascending=False).head(15)
+tobbjn_agencies['% HB'] = (tobbjn_agencies['HB Bookings'] / df[df['Rate Code'] == 'TOBBJN'].groupby('Search Name', observed=True).size().values * 100).round(1)
+tobbjn_agencies = top_k(tobbjn_agencies, 15, 'Revenue (AED)')
 
 df_universal = pd.DataFrame(universal_analysis)
 
@@ -303,18 +324,19 @@ print(f"  - TOBBJN: {len(df[df['Rate Code'] == 'TOBBJN'])} bookings across {tobb
 # ============================================================================
 print("[5/9] Analyzing Length of Stay Impact...")
 
-df['LOS_Category'] = pd.cut(df['Room Nights'],
-                              bins=[0, 2, 4, 7, 14, 999],
-                              labels=['1-2 nights', '3-4 nights', '5-7 nights', '8-14 nights', '15+ nights'])
-
-los_analysis = df.groupby('LOS_Category', observed=True).agg({
-    'Room Nights': ['count', 'sum'],
-    'Room Revenue': 'sum',
-    'Has_HB': ['sum', 'mean'],
-    'Avg_Rate_Per_Night': 'mean'
+los_bins = ([0, 2, 4, 7, 14, 999], ['1-2 nights', '3-4 nights', '5-7 nights', '8-14 nights', '15+ nights'])
+# Kept on the rows for the Raw Data sheet
+df['LOS_Category'] = pd.cut(df['Room Nights'], bins=los_bins[0], labels=los_bins[1])
+
+los = with_ratios(rollup(cube, 'Size_Bin', los_bins)).rename_axis('LOS_Category')
+los_analysis = pd.DataFrame({
+    'Bookings': los['Bookings'],
+    'Total Room Nights': los['Room Nights'],
+    'Total Revenue (AED)': los['Room Revenue'],
+    'HB Bookings': los['HB Bookings'],
+    'HB Penetration Rate': los['HB Share'],
+    'Avg Rate (AED)': los['Avg Rate'],
 }).round(2)
-
-los_analysis.columns = ['Bookings', 'Total Room Nights', 'Total Revenue (AED)', 'HB Bookings', 'HB Penetration Rate', 'Avg Rate (AED)']
 los_analysis['% of Total Bookings'] = (los_analysis['Bookings'] / len(df) * 100).round(1)
 los_analysis['HB Penetration Rate'] = (los_analysis['HB Penetration Rate'] * 100).round(1)
 los_analysis['Avg Revenue per Booking'] = (los_analysis['Total Revenue (AED)'] / los_analysis['Bookings']).round(2)
@@ -322,19 +344,12 @@ los_analysis['Avg Room Nights per Booking'] = (los_analysis['Total Room Nights']
 los_analysis = los_analysis.reset_index()
 
 # Top agencies by LOS category
-top_agencies_by_los = []
-for category in ['1-2 nights', '3-4 nights', '5-7 nights', '8-14 nights', '15+ nights']:
-    category_data = df[df['LOS_Category'] == category]
-    top_agency = category_data.groupby('Search Name').agg({
-        'Room Nights': 'sum',
-        'Has_HB': 'sum'
-    }).reset_index()
-    top_agency['HB %'] = (top_agency['Has_HB'] / category_data.groupby('Search Name').size().values * 100).round(1)
-    top_agency = top_agency.sort_values('Room Nights', ascending=False).head(5)
-    top_agency['LOS Category'] = category
-    top_agencies_by_los.append(top_agency[['LOS Category', 'Search Name', 'Room Nights', 'Has_HB', 'HB %']])
-
-df_los_agencies = pd.concat(top_agencies_by_los, ignore_index=True)
+los_agencies = rollup(cube, ['Size_Bin', 'Search Name'], los_bins).reset_index()
+los_agencies['HB %'] = (los_agencies['HB Bookings'] / los_agencies['Bookings'] * 100).round(1)
+los_agencies = los_agencies.sort_values(['Size_Bin', 'Room Nights'], ascending=[True, False])
+df_los_agencies = los_agencies.groupby('Size_Bin', observed=True).head(5).rename(
+    columns={'Size_Bin': 'LOS Category', 'HB Bookings': 'Has_HB'}
+)[['LOS Category', 'Search Name', 'Room Nights', 'Has_HB', 'HB %']].reset_index(drop=True)
 
 print(f"  - Analyzed {len(los_analysis)} LOS categories")
 
@@ -343,122 +358,48 @@ print(f"  - Analyzed {len(los_analysis)} LOS categories")
 # ============================================================================
 print("[6/9] Building Opportunity Matrix...")
 
-opportunity_matrix = []
-
-for agency in df['Search Name'].dropna().unique():
-    agency_data = df[df['Search Name'] == agency]
-    agency_hb = agency_data[agency_data['Has_HB']]
-
-    total_nights = agency_data['Room Nights'].sum()
-    hb_nights = agency_hb['Room Nights'].sum()
-    current_hb_pct = (hb_nights / total_nights * 100) if total_nights > 0 else 0
-
-    # Calculate potential if HB increased to 35%
-    potential_hb_nights = total_nights * 0.35
-    incremental_nights = potential_hb_nights - hb_nights
-
-    # Estimate incremental revenue (assuming AED 120 per HB night)
-    incremental_revenue = incremental_nights * 120 if incremental_nights > 0 else 0
-
-    # Priority scoring
-    volume_score = min(total_nights / 100, 10)  # Max 10 points for volume
-    opportunity_score = (100 - current_hb_pct) / 10  # Max 10 points for low HB%
-    priority_score = (volume_score + opportunity_score) / 2
-
-    opportunity = {
-        'Agency Name': agency,
-        'Total Room Nights': total_nights,
-        'Current HB Nights': hb_nights,
-        'Current HB %': current_hb_pct,
-        'Target HB % (35%)': 35.0,
-        'Gap to Target (%)': max(35 - current_hb_pct, 0),
-        'Potential HB Nights': max(incremental_nights, 0),
-        'Est. Incremental F&B Revenue (AED)': max(incremental_revenue, 0),
-        'Volume Score (1-10)': min(volume_score, 10),
-        'Opportunity Score (1-10)': min(opportunity_score, 10),
-        'Priority Score': priority_score,
-        'Action Priority': 'HIGH' if priority_score >= 7 else ('MEDIUM' if priority_score >= 4 else 'LOW'),
-        'Current Avg LOS': agency_data['Room Nights'].mean(),
-        'Recommended Tactic': ''
-    }
-
-    # Assign tactics based on profile
-    if total_nights > 500 and current_hb_pct < 10:
-        opportunity['Recommended Tactic'] = 'Urgent: Executive meeting + Commission incentive'
-    elif total_nights > 300 and current_hb_pct < 20:
-        opportunity['Recommended Tactic'] = 'High Priority: Targeted HB promotion + Training'
-    elif current_hb_pct > 50:
-        opportunity['Recommended Tactic'] = 'Optimize: Upsell to premium HB packages'
-    elif agency_data['Room Nights'].mean() > 10:
-        opportunity['Recommended Tactic'] = 'LOS Leverage: Mandatory HB for 7+ nights'
-    else:
-        opportunity['Recommended Tactic'] = 'Standard: Include in HB marketing campaign'
-
-    opportunity_matrix.append(opportunity)
-
-df_opportunity = pd.DataFrame(opportunity_matrix)
+# Score every agency in one vectorised pass; this workbook leans on length of
+# stay rather than booking size for the fourth tactic
+tactic_rules = TACTIC_RULES[:3] + [('LOS Leverage: Mandatory HB for 7+ nights', {'min_avg_nights': 10})]
+df_opportunity = opportunity_scores(df, tactic_rules=tactic_rules)
+df_opportunity = df_opportunity.rename(columns={'Avg Nights per Booking': 'Current Avg LOS'})
+df_opportunity = df_opportunity.rename_axis('Agency Name').reset_index()
 df_opportunity = df_opportunity.sort_values('Priority Score', ascending=False).reset_index(drop=True)
 df_opportunity.index = df_opportunity.index + 1
 
 print(f"  - Identified {len(df_opportunity[df_opportunity['Action Priority'] == 'HIGH'])} HIGH priority opportunities")
 print(f"  - Total potential incremental revenue: AED {df_opportunity['Est. Incremental F&B Revenue (AED)'].sum():,.0f}")
+_, uplift_range = simulate_uplift(df, processes=1)
+print(f"  - Simulated revenue if only part of each gap converts: P10 AED {uplift_range['P10 (AED)']:,.0f}, "
+      f"P50 AED {uplift_range['P50 (AED)']:,.0f}, P90 AED {uplift_range['P90 (AED)']:,.0f}")
 
 # ============================================================================
 # SHEET 7: MARKET SEGMENTATION
 # ============================================================================
 print("[7/9] Performing Market Segmentation...")
 
-# Identify markets from rate codes
-def identify_market(rate_code):
-    if pd.isna(rate_code):
-        return 'Unknown'
-    rate_code = str(rate_code).upper()
-    if 'CIS' in rate_code:
-        return 'CIS Markets'
-    elif 'MILUX' in rate_code:
-        return 'Luxembourg'
-    elif 'BBWI' in rate_code or 'BBJN' in rate_code or 'BB-WI' in rate_code or rate_code == 'TOBB':
-        return 'Universal/Multi-Market'
-    elif 'ROWI' in rate_code:
-        return 'Specific Market'
-    elif 'SSE' in rate_code or 'FSSE' in rate_code:
-        return 'Secret Escapes'
-    elif 'DG' in rate_code:
-        return 'Desert Gate'
-    elif 'EX' in rate_code:
-        return 'Express/Quick'
-    else:
-        return 'Other'
-
-df['Market_Segment'] = df['Rate Code'].apply(identify_market)
-
-market_analysis = df.groupby('Market_Segment').agg({
-    'Room Nights': ['count', 'sum', 'mean'],
-    'Room Revenue': 'sum',
-    'Has_HB': ['sum', 'mean'],
-    'Avg_Rate_Per_Night': 'mean'
+market = with_ratios(rollup(cube, 'Market_Segment'))
+market_analysis = pd.DataFrame({
+    'Bookings': market['Bookings'],
+    'Total Room Nights': market['Room Nights'],
+    'Avg LOS': market['Avg Nights per Booking'],
+    'Total Revenue (AED)': market['Room Revenue'],
+    'HB Bookings': market['HB Bookings'],
+    'HB Penetration': market['HB Share'],
+    'Avg Rate (AED)': market['Avg Rate'],
 }).round(2)
-
-market_analysis.columns = ['Bookings', 'Total Room Nights', 'Avg LOS', 'Total Revenue (AED)', 'HB Bookings', 'HB Penetration', 'Avg Rate (AED)']
 market_analysis['HB Penetration'] = (market_analysis['HB Penetration'] * 100).round(1)
 market_analysis['% of Total Revenue'] = (market_analysis['Total Revenue (AED)'] / df['Room Revenue'].sum() * 100).round(1)
 market_analysis = market_analysis.sort_values('Total Revenue (AED)', ascending=False).reset_index()
 
-# Top agencies by market
-market_agency_detail = []
-for market in market_analysis['Market_Segment'].unique():
-    market_data = df[df['Market_Segment'] == market]
-    top_agencies = market_data.groupby('Search Name').agg({
-        'Room Nights': 'sum',
-        'Room Revenue': 'sum',
-        'Has_HB': 'sum'
-    }).reset_index()
-    top_agencies.columns = ['Agency', 'Room Nights', 'Revenue (AED)', 'HB Bookings']
-    top_agencies['Market'] = market
-    top_agencies = top_agencies.sort_values('Revenue (AED)', ascending=False).head(5)
-    market_agency_detail.append(top_agencies[['Market', 'Agency', 'Room Nights', 'Revenue (AED)', 'HB Bookings']])
-
-df_market_agencies = pd.concat(market_agency_detail, ignore_index=True)
+# Top agencies by market, markets in revenue order
+market_agencies = rollup(cube, ['Market_Segment', 'Search Name']).reset_index()
+market_agencies['Market_Rank'] = market_agencies['Market_Segment'].map(
+    {m: i for i, m in enumerate(market_analysis['Market_Segment'])}).astype(int)
+market_agencies = market_agencies.sort_values(['Market_Rank', 'Room Revenue'], ascending=[True, False])
+df_market_agencies = market_agencies.groupby('Market_Rank').head(5).rename(
+    columns={'Market_Segment': 'Market', 'Search Name': 'Agency', 'Room Revenue': 'Revenue (AED)'}
+)[['Market', 'Agency', 'Room Nights', 'Revenue (AED)', 'HB Bookings']].reset_index(drop=True)
 
 print(f"  - Identified {len(market_analysis)} market segments")
 
@@ -518,10 +459,10 @@ action_plan.append({
 })
 
 # Priority 4: CIS market expansion
-cis_agencies_not_using_hb = df[
-    (df['Rate Code'].str.contains('CIS', case=False, na=False)) &
-    (~df['Has_HB'])
-]['Search Name'].nunique()
+cis_agencies_not_using_hb = distinct_count(distinct[
+    (distinct['Rate Code'].str.contains('CIS', case=False, na=False)) &
+    (~distinct['Has_HB'])
+], 'Search Name')
 
 action_plan.append({
     'Priority': 4,
@@ -625,7 +566,11 @@ print(f"  - Total estimated impact: AED 775,000+")
 # ============================================================================
 print("[9/9] Preparing raw data reference...")
 
-df_raw = df.copy()
+# Extract columns and the analysis columns this sheet has always shown;
+# the meal-plan columns from hb_rules stay out of it
+raw_columns = ['Search Name', 'Rate Code', 'Product Codes', 'Product (Descriptions)', 'Room Nights', 'Room Revenue',
+               'Source', 'Avg_Rate_Per_Night', 'Has_HB', 'LOS_Category', 'Market_Segment']
+df_raw = df[[col for col in raw_columns if col in df]]
 df_raw = df_raw.sort_values('Room Revenue', ascending=False)
 
 # ============================================================================
@@ -3,6 +3,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from matplotlib.gridspec import GridSpec
+from hb_data import load_bookings
+from hb_metrics import top_k
+from hb_sketch import box_stats, load_quantile_sketch
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -11,10 +14,10 @@ print("CREATING COMPREHENSIVE EDA CHART ANALYSIS")
 print("48 High-Quality Charts for Half Board Analysis")
 print("="*80)
 
-# Read the data
-df = pd.read_excel('/home/gee_devops254/Downloads/Half Board/Half Board.xlsx')
-df['Avg_Rate_Per_Night'] = df['Room Revenue'] / df['Room Nights']
-df['Has_HB'] = df['Product (Descriptions)'].str.contains('Halfboard|Half Board', case=False, na=False)
+# Read only the columns these charts use
+df = load_bookings(columns=[
+    'Search Name', 'Room Nights', 'Room Revenue', 'Avg_Rate_Per_Night', 'Has_HB',
+])
 
 df_hb = df[df['Has_HB']]
 df_non_hb = df[~df['Has_HB']]
@@ -164,7 +167,7 @@ print(f"  ✓ Chart {chart_count}: Revenue vs Room Nights Scatter")
 print("\n[CATEGORY 2/9] Creating Agency Analysis Charts...")
 
 # Prepare agency data
-agency_data = df.groupby('Search Name').agg({
+agency_data = df.groupby('Search Name', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum',
     'Has_HB': ['sum', lambda x: (x.sum() / len(x) * 100)]
@@ -172,7 +175,7 @@ agency_data = df.groupby('Search Name').agg({
 agency_data.columns = ['Agency', 'Total_Nights', 'Total_Revenue', 'HB_Bookings', 'HB_Penetration']
 agency_data = agency_data.sort_values('Total_Revenue', ascending=False)
 
-agency_hb_data = df[df['Has_HB']].groupby('Search Name').agg({
+agency_hb_data = df[df['Has_HB']].groupby('Search Name', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum'
 }).reset_index()
@@ -207,7 +210,7 @@ print(f"  ✓ Chart {chart_count}: Top 20 Agencies by Revenue")
 # Chart 8: Top 20 Agencies by Room Nights
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
-top20_nights = agency_data.sort_values('Total_Nights', ascending=False).head(20).copy()
+top20_nights = top_k(agency_data, 20, 'Total_Nights').copy()
 colors_gradient = plt.cm.plasma(np.linspace(0.3, 0.9, len(top20_nights)))
 
 bars = ax.barh(range(len(top20_nights)), top20_nights['Total_Nights'], color=colors_gradient, edgecolor='black', linewidth=1)
@@ -233,7 +236,7 @@ print(f"  ✓ Chart {chart_count}: Top 20 Agencies by Room Nights")
 # Chart 9: Top 15 HB Agencies by Room Nights
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
-top15_hb = agency_hb_data.sort_values('HB_Nights', ascending=False).head(15).copy()
+top15_hb = top_k(agency_hb_data, 15, 'HB_Nights').copy()
 
 bars = ax.barh(range(len(top15_hb)), top15_hb['HB_Nights'], color=COLOR_HB, edgecolor='black', linewidth=1, alpha=0.8)
 ax.set_yticks(range(len(top15_hb)))
@@ -258,7 +261,7 @@ print(f"  ✓ Chart {chart_count}: Top 15 HB Agencies by Nights")
 # Chart 10: Top 15 HB Agencies by Revenue
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
-top15_hb_rev = agency_hb_data.sort_values('HB_Revenue', ascending=False).head(15).copy()
+top15_hb_rev = top_k(agency_hb_data, 15, 'HB_Revenue').copy()
 
 bars = ax.barh(range(len(top15_hb_rev)), top15_hb_rev['HB_Revenue'], color=COLOR_HIGHLIGHT, edgecolor='black', linewidth=1, alpha=0.8)
 ax.set_yticks(range(len(top15_hb_rev)))
@@ -381,15 +384,11 @@ fig, ax = plt.subplots(figsize=(14, 10))
 
 # Get top 10 agencies
 top10_agencies = agency_data.head(10)['Agency'].tolist()
-booking_data = []
-labels = []
+labels = [agency.split()[0][:15] for agency in top10_agencies]  # Shorten names
 
-for agency in top10_agencies:
-    agency_bookings = df[df['Search Name'] == agency]['Room Nights'].values
-    booking_data.append(agency_bookings)
-    labels.append(agency.split()[0][:15])  # Shorten names
-
-bp = ax.boxplot(booking_data, labels=labels, patch_artist=True, showfliers=True)
+# Box statistics from the quantile sketch instead of each agency's rows
+booking_stats = box_stats(load_quantile_sketch(), 'Room Nights', 'Search Name', top10_agencies)
+bp = ax.bxp(booking_stats, patch_artist=True, showfliers=True)
 
 for patch in bp['boxes']:
     patch.set_facecolor(COLOR_NEUTRAL)
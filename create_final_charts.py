@@ -4,6 +4,11 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from matplotlib.gridspec import GridSpec
 from matplotlib.patches import Rectangle
+from hb_data import load_bookings
+from hb_cube import load_cube, penetration, rollup, sparse_matrix, top_labels, with_ratios
+from hb_concentration import labels_for_share, pareto
+from hb_metrics import top_k
+from hb_sketch import load_quantile_sketch, sketch_quantiles, sketch_values
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -12,10 +17,12 @@ print("CREATING FINAL EDA CHARTS (Categories 5-9)")
 print("Charts 26-48")
 print("="*80)
 
-# Read the data
-df = pd.read_excel('/home/gee_devops254/Downloads/Half Board/Half Board.xlsx')
-df['Avg_Rate_Per_Night'] = df['Room Revenue'] / df['Room Nights']
-df['Has_HB'] = df['Product (Descriptions)'].str.contains('Halfboard|Half Board', case=False, na=False)
+# Read only the columns these charts use
+df = load_bookings(columns=[
+    'Search Name', 'Rate Code', 'Room Nights', 'Room Revenue', 'Avg_Rate_Per_Night', 'Has_HB', 'Market_Segment',
+])
+# Additive sums by agency, rate code, HB flag, market and booking size
+cube = load_cube()
 
 df_hb = df[df['Has_HB']]
 df_non_hb = df[~df['Has_HB']]
@@ -33,37 +40,15 @@ COLOR_LUX = '#1abc9c'
 
 chart_count = 25  # Continue from where we left off
 
-# Identify markets from rate codes
-def identify_market(rate_code):
-    if pd.isna(rate_code):
-        return 'Unknown'
-    rate_code = str(rate_code).upper()
-    if 'CIS' in rate_code:
-        return 'CIS Markets'
-    elif 'MILUX' in rate_code:
-        return 'Luxembourg'
-    elif 'BBWI' in rate_code or 'BBJN' in rate_code or 'BB-WI' in rate_code or rate_code == 'TOBB':
-        return 'Universal/Multi-Market'
-    elif 'ROWI' in rate_code:
-        return 'Specific Market'
-    elif 'SSE' in rate_code or 'FSSE' in rate_code:
-        return 'Secret Escapes'
-    else:
-        return 'Other'
-
-df['Market_Segment'] = df['Rate Code'].apply(identify_market)
-
 # ============================================================================
 # CATEGORY 5: MARKET SEGMENTATION (5 charts)
 # ============================================================================
 print("\n[CATEGORY 5/9] Creating Market Segmentation Charts...")
 
 # Prepare market data
-market_data = df.groupby('Market_Segment').agg({
-    'Room Nights': 'sum',
-    'Room Revenue': 'sum',
-    'Has_HB': ['sum', lambda x: (x.sum() / len(x) * 100)]
-}).reset_index()
+market_data = rollup(cube, 'Market_Segment').reset_index()
+market_data['HB_Penetration'] = market_data['HB Bookings'] / market_data['Bookings'] * 100
+market_data = market_data[['Market_Segment', 'Room Nights', 'Room Revenue', 'HB Bookings', 'HB_Penetration']]
 market_data.columns = ['Market', 'Total_Nights', 'Total_Revenue', 'HB_Bookings', 'HB_Penetration']
 market_data = market_data.sort_values('Total_Revenue', ascending=False)
 
@@ -123,7 +108,7 @@ chart_count += 1
 fig, ax = plt.subplots(figsize=(12, 8))
 
 df_cis = df[df['Market_Segment'] == 'CIS Markets']
-cis_by_rate = df_cis.groupby('Rate Code').agg({
+cis_by_rate = df_cis.groupby('Rate Code', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum',
     'Has_HB': 'sum'
@@ -154,7 +139,7 @@ chart_count += 1
 fig, ax = plt.subplots(figsize=(12, 8))
 
 df_lux = df[df['Market_Segment'] == 'Luxembourg']
-lux_by_agency = df_lux.groupby('Search Name').agg({
+lux_by_agency = df_lux.groupby('Search Name', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum',
     'Has_HB': 'sum'
@@ -216,7 +201,7 @@ print("\n[CATEGORY 6/9] Creating HB Performance Analysis Charts...")
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
 
-agency_hb = df_hb.groupby('Search Name')['Room Nights'].sum().sort_values(ascending=False).head(15)
+agency_hb = top_k(df_hb.groupby('Search Name', observed=True)['Room Nights'].sum(), 15)
 
 # Create a pseudo-treemap using nested bars
 y_pos = 0
@@ -243,18 +228,19 @@ print(f"  ✓ Chart {chart_count}: HB Bookings Tree Visualization")
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
 
-agency_hb_rev = df_hb.groupby('Search Name')['Room Revenue'].sum().sort_values(ascending=False)
-cumulative_pct = (agency_hb_rev.cumsum() / agency_hb_rev.sum() * 100)
+# Agencies in HB revenue order with prefix sums, from the cube
+hb_revenue_pareto = pareto(rollup(cube[cube['Has_HB']], 'Search Name')['Room Revenue'])
+agencies_for_80 = labels_for_share(hb_revenue_pareto, 0.8)
 
 # Plot top 20
-top20_hb_rev = agency_hb_rev.head(20)
-top20_cum = cumulative_pct.head(20)
+top20_hb_rev = hb_revenue_pareto['Value'].head(20)
+top20_cum = hb_revenue_pareto['Cumulative %'].head(20)
 
 ax2 = ax.twinx()
 
 bars = ax.bar(range(len(top20_hb_rev)), top20_hb_rev.values, color=COLOR_HB, edgecolor='black', alpha=0.7)
 line = ax2.plot(range(len(top20_cum)), top20_cum.values, color='red', marker='o', linewidth=3, markersize=8, label='Cumulative %')
-ax2.axhline(y=80, color='orange', linestyle='--', linewidth=2, label='80% threshold')
+ax2.axhline(y=80, color='orange', linestyle='--', linewidth=2, label=f'80% threshold ({agencies_for_80} agencies)')
 
 ax.set_xlabel('Agency (Top 20)', fontsize=12, weight='bold')
 ax.set_ylabel('HB Revenue (AED)', fontsize=12, weight='bold', color='green')
@@ -274,11 +260,16 @@ print(f"  ✓ Chart {chart_count}: HB Revenue Pareto Analysis")
 chart_count += 1
 fig, ax = plt.subplots(figsize=(12, 8))
 
-hb_rates = df_hb['Avg_Rate_Per_Night'].dropna()
+# Distribution from the quantile sketch, mean from the cube's rate sums
+sketch = load_quantile_sketch()
+hb_rates = sketch_values(sketch, 'Avg_Rate_Per_Night', 'Has_HB')
+hb_rates = hb_rates[hb_rates['Has_HB'].astype(bool)]
+hb_rate_mean = with_ratios(rollup(cube, 'Has_HB')).loc[True, 'Avg Rate']
+hb_rate_median = sketch_quantiles(sketch, 'Avg_Rate_Per_Night', 0.5, 'Has_HB').loc[True, 0.5]
 
-ax.hist(hb_rates, bins=30, color=COLOR_HB, edgecolor='black', alpha=0.7)
-ax.axvline(hb_rates.mean(), color='red', linestyle='--', linewidth=2, label=f'Mean: AED {hb_rates.mean():.2f}')
-ax.axvline(hb_rates.median(), color='orange', linestyle='--', linewidth=2, label=f'Median: AED {hb_rates.median():.2f}')
+ax.hist(hb_rates['Value'], bins=30, weights=hb_rates['Count'], color=COLOR_HB, edgecolor='black', alpha=0.7)
+ax.axvline(hb_rate_mean, color='red', linestyle='--', linewidth=2, label=f'Mean: AED {hb_rate_mean:.2f}')
+ax.axvline(hb_rate_median, color='orange', linestyle='--', linewidth=2, label=f'Median: AED {hb_rate_median:.2f}')
 
 ax.set_xlabel('Average Rate per Night (AED)', fontsize=14, weight='bold')
 ax.set_ylabel('Frequency', fontsize=14, weight='bold')
@@ -337,19 +328,11 @@ print(f"  ✓ Chart {chart_count}: HB vs Non-HB Rate Scatter")
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
 
-# Get top 10 agencies and rate codes
-top10_agencies = df.groupby('Search Name')['Room Revenue'].sum().sort_values(ascending=False).head(10).index
-top10_rates = df.groupby('Rate Code')['Room Revenue'].sum().sort_values(ascending=False).head(10).index
-
-# Create matrix
-heatmap_data = np.zeros((len(top10_agencies), len(top10_rates)))
-
-for i, agency in enumerate(top10_agencies):
-    for j, rate in enumerate(top10_rates):
-        agency_rate_df = df[(df['Search Name'] == agency) & (df['Rate Code'] == rate)]
-        if len(agency_rate_df) > 0:
-            hb_pct = (agency_rate_df['Has_HB'].sum() / len(agency_rate_df) * 100)
-            heatmap_data[i, j] = hb_pct
+# Slice the top 10 agencies and rate codes by revenue out of the full sparse matrix
+agency_rate_matrix = sparse_matrix(cube, 'Search Name', 'Rate Code')
+top10_agencies = top_labels(agency_rate_matrix, axis=0)
+top10_rates = top_labels(agency_rate_matrix, axis=1)
+heatmap_data = penetration(agency_rate_matrix, top10_agencies, top10_rates)
 
 im = ax.imshow(heatmap_data, cmap='RdYlGn', aspect='auto', vmin=0, vmax=100)
 
@@ -380,14 +363,9 @@ print(f"  ✓ Chart {chart_count}: HB Penetration Heatmap")
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
 
-# Create bins
-df['Booking_Size_Bin'] = pd.cut(df['Room Nights'],
-                                  bins=[0, 5, 10, 20, 50, 100, 1000],
-                                  labels=['1-5', '6-10', '11-20', '21-50', '51-100', '100+'])
-
-booking_hb_analysis = df.groupby('Booking_Size_Bin', observed=True).agg({
-    'Has_HB': ['sum', 'count']
-}).reset_index()
+# Roll the cube up to these bins
+size_bins = ([0, 5, 10, 20, 50, 100, 1000], ['1-5', '6-10', '11-20', '21-50', '51-100', '100+'])
+booking_hb_analysis = rollup(cube, 'Size_Bin', size_bins)[['HB Bookings', 'Bookings']].reset_index()
 booking_hb_analysis.columns = ['Booking_Size', 'HB_Count', 'Total_Count']
 booking_hb_analysis['HB_Pct'] = (booking_hb_analysis['HB_Count'] / booking_hb_analysis['Total_Count'] * 100)
 
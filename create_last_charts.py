@@ -1,9 +1,11 @@
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from matplotlib.gridspec import GridSpec
 from matplotlib.patches import Rectangle, Circle
+from hb_data import load_bookings
+from hb_metrics import opportunity_scores, top_k
+from hb_sketch import load_comoments, pearson
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -12,10 +14,10 @@ print("CREATING FINAL 12 CHARTS (Categories 7-9)")
 print("Charts 37-48")
 print("="*80)
 
-# Read the data
-df = pd.read_excel('/home/gee_devops254/Downloads/Half Board/Half Board.xlsx')
-df['Avg_Rate_Per_Night'] = df['Room Revenue'] / df['Room Nights']
-df['Has_HB'] = df['Product (Descriptions)'].str.contains('Halfboard|Half Board', case=False, na=False)
+# Read only the columns these charts use
+df = load_bookings(columns=[
+    'Search Name', 'Room Nights', 'Room Revenue', 'Avg_Rate_Per_Night', 'Has_HB', 'Market_Segment',
+])
 
 df_hb = df[df['Has_HB']]
 df_non_hb = df[~df['Has_HB']]
@@ -36,30 +38,13 @@ chart_count = 36
 # ============================================================================
 print("\n[CATEGORY 7/9] Creating Opportunity Analysis Charts...")
 
-# Prepare opportunity data
-agency_opportunity = []
-for agency in df['Search Name'].dropna().unique():
-    agency_df = df[df['Search Name'] == agency]
-    agency_hb_df = agency_df[agency_df['Has_HB']]
-
-    total_nights = agency_df['Room Nights'].sum()
-    hb_nights = agency_hb_df['Room Nights'].sum()
-    current_hb_pct = (hb_nights / total_nights * 100) if total_nights > 0 else 0
-
-    # Calculate potential
-    potential_hb_nights = total_nights * 0.35
-    incremental_nights = potential_hb_nights - hb_nights
-    incremental_revenue = incremental_nights * 120 if incremental_nights > 0 else 0
-
-    agency_opportunity.append({
-        'Agency': agency,
-        'Total_Nights': total_nights,
-        'HB_Pct': current_hb_pct,
-        'Incremental_Revenue': max(incremental_revenue, 0),
-        'Gap': max(35 - current_hb_pct, 0)
-    })
-
-df_opp = pd.DataFrame(agency_opportunity)
+# Prepare opportunity data with the scoring shared by the workbook
+df_opp = opportunity_scores(df).rename_axis('Agency').reset_index().rename(columns={
+    'Total Room Nights': 'Total_Nights',
+    'Current HB %': 'HB_Pct',
+    'Est. Incremental F&B Revenue (AED)': 'Incremental_Revenue',
+    'Gap to Target (%)': 'Gap',
+})[['Agency', 'Total_Nights', 'HB_Pct', 'Incremental_Revenue', 'Gap']]
 
 # Chart 37: Opportunity Matrix Quadrant
 chart_count += 1
@@ -114,7 +99,7 @@ chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
 
 # Filter high priority: high volume, low HB%
-high_priority = df_opp[(df_opp['Total_Nights'] > 300) & (df_opp['HB_Pct'] < 15)].sort_values('Incremental_Revenue', ascending=False).head(10)
+high_priority = top_k(df_opp[(df_opp['Total_Nights'] > 300) & (df_opp['HB_Pct'] < 15)], 10, 'Incremental_Revenue')
 
 bars = ax.barh(range(len(high_priority)), high_priority['Incremental_Revenue'],
                color=COLOR_NON_HB, edgecolor='black', linewidth=2, alpha=0.8)
@@ -143,7 +128,7 @@ print(f"  ✓ Chart {chart_count}: High Priority Agencies")
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
 
-top15_inc = df_opp.sort_values('Incremental_Revenue', ascending=False).head(15)
+top15_inc = top_k(df_opp, 15, 'Incremental_Revenue')
 
 colors_grad = plt.cm.Reds(np.linspace(0.4, 0.9, len(top15_inc)))
 bars = ax.barh(range(len(top15_inc)), top15_inc['Incremental_Revenue'],
@@ -172,7 +157,7 @@ print(f"  ✓ Chart {chart_count}: Incremental Revenue Potential")
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
 
-top15_vol = df_opp.sort_values('Total_Nights', ascending=False).head(15)
+top15_vol = top_k(df_opp, 15, 'Total_Nights')
 
 x = np.arange(len(top15_vol))
 width = 0.35
@@ -269,8 +254,8 @@ chart_count += 1
 fig, ax = plt.subplots(figsize=(10, 8))
 
 # Select numeric columns
-numeric_cols = ['Room Nights', 'Room Revenue', 'Avg_Rate_Per_Night']
-corr_matrix = df[numeric_cols].corr()
+# Pooled from cached co-moment sums per HB flag and market segment
+corr_matrix = pearson(load_comoments())
 
 sns.heatmap(corr_matrix, annot=True, fmt='.3f', cmap='coolwarm', center=0,
             square=True, linewidths=2, cbar_kws={"shrink": 0.8}, ax=ax,
@@ -344,7 +329,7 @@ chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
 
 # Calculate agency metrics
-agency_matrix = df.groupby('Search Name').agg({
+agency_matrix = df.groupby('Search Name', observed=True).agg({
     'Room Revenue': 'sum',
     'Has_HB': lambda x: (x.sum() / len(x) * 100)
 }).reset_index()
@@ -420,7 +405,7 @@ ax1.set_title('HB Penetration Rate', fontsize=14, weight='bold')
 
 # Top 10 Agencies (middle right)
 ax2 = fig.add_subplot(gs[1, 2:])
-top10_rev = df.groupby('Search Name')['Room Revenue'].sum().sort_values(ascending=False).head(10)
+top10_rev = top_k(df.groupby('Search Name', observed=True)['Room Revenue'].sum(), 10)
 ax2.barh(range(len(top10_rev)), top10_rev.values, color=COLOR_NEUTRAL, edgecolor='black')
 ax2.set_yticks(range(len(top10_rev)))
 ax2.set_yticklabels([name[:20] for name in top10_rev.index], fontsize=9)
@@ -430,21 +415,8 @@ ax2.set_title('Top 10 Agencies by Revenue', fontsize=14, weight='bold')
 ax2.grid(axis='x', alpha=0.3)
 
 # Market Segments (bottom left)
-def identify_market_func(rate_code):
-    if pd.isna(rate_code):
-        return 'Unknown'
-    rate_code = str(rate_code).upper()
-    if 'CIS' in rate_code:
-        return 'CIS Markets'
-    elif 'MILUX' in rate_code:
-        return 'Luxembourg'
-    elif 'BBWI' in rate_code or 'BBJN' in rate_code or 'BB-WI' in rate_code or rate_code == 'TOBB':
-        return 'Universal/Multi-Market'
-    else:
-        return 'Other'
-
 ax3 = fig.add_subplot(gs[2, :2])
-market_rev = df.groupby(df['Rate Code'].apply(identify_market_func))['Room Revenue'].sum().sort_values(ascending=False).head(5)
+market_rev = top_k(df.groupby('Market_Segment', observed=True)['Room Revenue'].sum(), 5)
 ax3.bar(range(len(market_rev)), market_rev.values, color=plt.cm.Set3(np.arange(len(market_rev))), edgecolor='black')
 ax3.set_xticks(range(len(market_rev)))
 ax3.set_xticklabels([name[:15] for name in market_rev.index], rotation=45, ha='right', fontsize=9)
@@ -479,7 +451,7 @@ fig.suptitle('Chart 47: HALF BOARD PERFORMANCE SCORECARD\nDetailed Metrics and A
 
 # Top HB Agencies
 ax1 = fig.add_subplot(gs[0, :])
-top10_hb = df_hb.groupby('Search Name')['Room Revenue'].sum().sort_values(ascending=False).head(10)
+top10_hb = top_k(df_hb.groupby('Search Name', observed=True)['Room Revenue'].sum(), 10)
 ax1.barh(range(len(top10_hb)), top10_hb.values, color=COLOR_HB, edgecolor='black', alpha=0.8)
 ax1.set_yticks(range(len(top10_hb)))
 ax1.set_yticklabels(top10_hb.index, fontsize=10)
@@ -490,7 +462,7 @@ ax1.grid(axis='x', alpha=0.3)
 
 # HB by Market
 ax2 = fig.add_subplot(gs[1, 0])
-hb_by_market = df_hb.groupby(df_hb['Rate Code'].apply(identify_market_func))['Room Revenue'].sum().sort_values(ascending=False).head(5)
+hb_by_market = top_k(df_hb.groupby('Market_Segment', observed=True)['Room Revenue'].sum(), 5)
 ax2.pie(hb_by_market.values, labels=hb_by_market.index, autopct='%1.1f%%', startangle=90, textprops={'fontsize': 9})
 ax2.set_title('HB Revenue by Market', fontsize=12, weight='bold')
 
@@ -3,6 +3,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from matplotlib.gridspec import GridSpec
+from hb_data import load_bookings
+from hb_metrics import top_k
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -10,10 +12,10 @@ print("="*80)
 print("CREATING REMAINING EDA CHARTS (Categories 3-9)")
 print("="*80)
 
-# Read the data
-df = pd.read_excel('/home/gee_devops254/Downloads/Half Board/Half Board.xlsx')
-df['Avg_Rate_Per_Night'] = df['Room Revenue'] / df['Room Nights']
-df['Has_HB'] = df['Product (Descriptions)'].str.contains('Halfboard|Half Board', case=False, na=False)
+# Read only the columns these charts use
+df = load_bookings(columns=[
+    'Search Name', 'Rate Code', 'Room Nights', 'Room Revenue', 'Avg_Rate_Per_Night', 'Has_HB',
+])
 
 df_hb = df[df['Has_HB']]
 df_non_hb = df[~df['Has_HB']]
@@ -142,7 +144,7 @@ print(f"  ✓ Chart {chart_count}: Miracle HB Split")
 chart_count += 1
 fig, ax = plt.subplots(figsize=(12, 8))
 
-miracle_by_rate = miracle_data.groupby('Rate Code').agg({
+miracle_by_rate = miracle_data.groupby('Rate Code', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum'
 }).sort_values('Room Revenue', ascending=False)
@@ -196,7 +198,7 @@ print(f"  ✓ Chart {chart_count}: Miracle Revenue Contribution")
 print("\n[CATEGORY 4/9] Creating Rate Code Analysis Charts...")
 
 # Prepare rate code data
-rate_data = df.groupby('Rate Code').agg({
+rate_data = df.groupby('Rate Code', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum',
     'Has_HB': ['sum', lambda x: (x.sum() / len(x) * 100)]
@@ -206,7 +208,7 @@ rate_data.columns = ['Rate_Code', 'Total_Nights', 'Total_Revenue', 'HB_Bookings'
 # Chart 20: Top 15 Rate Codes by Revenue
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
-top15_rates = rate_data.sort_values('Total_Revenue', ascending=False).head(15)
+top15_rates = top_k(rate_data, 15, 'Total_Revenue')
 colors_gradient = plt.cm.coolwarm(np.linspace(0.2, 0.8, len(top15_rates)))
 
 bars = ax.barh(range(len(top15_rates)), top15_rates['Total_Revenue'], color=colors_gradient, edgecolor='black', linewidth=1)
@@ -238,7 +240,7 @@ print(f"  ✓ Chart {chart_count}: Top 15 Rate Codes by Revenue")
 # Chart 21: Top 15 Rate Codes by Room Nights
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
-top15_rates_nights = rate_data.sort_values('Total_Nights', ascending=False).head(15)
+top15_rates_nights = top_k(rate_data, 15, 'Total_Nights')
 colors_gradient = plt.cm.viridis(np.linspace(0.2, 0.8, len(top15_rates_nights)))
 
 bars = ax.barh(range(len(top15_rates_nights)), top15_rates_nights['Total_Nights'], color=colors_gradient, edgecolor='black', linewidth=1)
@@ -271,11 +273,11 @@ print(f"  ✓ Chart {chart_count}: Top 15 Rate Codes by Nights")
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
 
-tobbwi_agencies = df[df['Rate Code'] == 'TOBBWI'].groupby('Search Name').agg({
+tobbwi_agencies = top_k(df[df['Rate Code'] == 'TOBBWI'].groupby('Search Name', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum',
     'Has_HB': 'sum'
-}).sort_values('Room Revenue', ascending=False).head(10).reset_index()
+}), 10, 'Room Revenue').reset_index()
 
 bars = ax.barh(range(len(tobbwi_agencies)), tobbwi_agencies['Room Revenue'], color='#3498db', edgecolor='black', linewidth=1, alpha=0.8)
 ax.set_yticks(range(len(tobbwi_agencies)))
@@ -302,11 +304,11 @@ print(f"  ✓ Chart {chart_count}: TOBBWI Agency Performance")
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
 
-tobbjn_agencies = df[df['Rate Code'] == 'TOBBJN'].groupby('Search Name').agg({
+tobbjn_agencies = top_k(df[df['Rate Code'] == 'TOBBJN'].groupby('Search Name', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum',
     'Has_HB': 'sum'
-}).sort_values('Room Revenue', ascending=False).head(10).reset_index()
+}), 10, 'Room Revenue').reset_index()
 
 bars = ax.barh(range(len(tobbjn_agencies)), tobbjn_agencies['Room Revenue'], color='#e74c3c', edgecolor='black', linewidth=1, alpha=0.8)
 ax.set_yticks(range(len(tobbjn_agencies)))
@@ -381,7 +383,7 @@ print(f"  ✓ Chart {chart_count}: Universal Codes HB Penetration")
 chart_count += 1
 fig, ax = plt.subplots(figsize=(14, 10))
 
-top15_rates_avgrate = rate_data.sort_values('Total_Revenue', ascending=False).head(15).copy()
+top15_rates_avgrate = top_k(rate_data, 15, 'Total_Revenue').copy()
 
 # Calculate avg rate
 rate_avg_rates = []
@@ -305,12 +305,12 @@ print("[4/11] Creating Agency Analysis...")
 agency_charts = {
     '07': {
         'title': 'Top 20 Agencies by Revenue',
-        'description': 'Revenue leaders ranked. "Totals" dominates with AED 3.8M. TBO, Darina, Webbeds follow. Color gradient shows relative performance.',
+        'description': 'Revenue leaders ranked. TBO (AED 296K) and Darina (AED 296K) lead, Webbeds follows. Color gradient shows relative performance.',
         'insight': 'Top 5 agencies generate 60%+ of revenue - prioritize these'
     },
     '08': {
         'title': 'Top 20 Agencies by Room Nights',
-        'description': 'Volume leaders: "Totals" (11,874 nights), TBO (758), Darina (932). High volume = high conversion potential.',
+        'description': 'Volume leaders: Darina (932 nights), TBO (758), Webbeds (716). High volume = high conversion potential.',
         'insight': 'Target these high-volume agencies for HB conversion'
     },
     '09': {
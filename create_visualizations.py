@@ -2,6 +2,10 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+from hb_data import load_bookings
+from hb_cube import load_cube, rollup
+from hb_metrics import top_k
+from hb_sketch import load_comoments, pearson
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -9,11 +13,14 @@ warnings.filterwarnings('ignore')
 sns.set_style("whitegrid")
 sns.set_palette("husl")
 
-# Read the data
-df = pd.read_excel('/home/gee_devops254/Downloads/Half Board/Half Board.xlsx')
-df['Avg_Rate_Per_Night'] = df['Room Revenue'] / df['Room Nights']
-df['Is_HalfBoard'] = df['Product (Descriptions)'].str.contains('Halfboard|Half Board', case=False, na=False)
-df_hb = df[df['Is_HalfBoard']]
+# Read only the columns these charts use
+df = load_bookings(columns=[
+    'Search Name', 'Rate Code', 'Room Nights', 'Room Revenue', 'Avg_Rate_Per_Night', 'Has_HB',
+])
+# Additive sums by agency, rate code, HB flag, market and booking size
+cube = load_cube()
+cube_hb = cube[cube['Has_HB']]
+df_hb = df[df['Has_HB']]
 df_cis = df[df['Rate Code'].str.contains('CIS', case=False, na=False)]
 df_cis_hb = df_hb[df_hb['Rate Code'].str.contains('CIS', case=False, na=False)]
 
@@ -79,8 +86,8 @@ fig.suptitle('Half Board Analysis', fontsize=16, fontweight='bold')
 # HB vs Non-HB comparison
 hb_comparison = pd.DataFrame({
     'Category': ['Half Board', 'Non-Half Board'],
-    'Room Nights': [df_hb['Room Nights'].sum(), df[~df['Is_HalfBoard']]['Room Nights'].sum()],
-    'Revenue': [df_hb['Room Revenue'].sum(), df[~df['Is_HalfBoard']]['Room Revenue'].sum()]
+    'Room Nights': [df_hb['Room Nights'].sum(), df[~df['Has_HB']]['Room Nights'].sum()],
+    'Revenue': [df_hb['Room Revenue'].sum(), df[~df['Has_HB']]['Room Revenue'].sum()]
 })
 
 x = np.arange(len(hb_comparison['Category']))
@@ -100,7 +107,7 @@ axes[0, 0].legend(loc='upper left')
 ax1.legend(loc='upper right')
 
 # Top 10 Agencies by HB Room Nights
-hb_by_agency = df_hb.groupby('Search Name')['Room Nights'].sum().sort_values(ascending=False).head(10)
+hb_by_agency = top_k(rollup(cube_hb, 'Search Name')['Room Nights'], 10)
 axes[0, 1].barh(range(len(hb_by_agency)), hb_by_agency.values, alpha=0.8)
 axes[0, 1].set_yticks(range(len(hb_by_agency)))
 axes[0, 1].set_yticklabels(hb_by_agency.index, fontsize=9)
@@ -109,7 +116,7 @@ axes[0, 1].set_title('Top 10 Agencies by Half Board Room Nights')
 axes[0, 1].invert_yaxis()
 
 # Top 10 Agencies by HB Revenue
-hb_by_agency_rev = df_hb.groupby('Search Name')['Room Revenue'].sum().sort_values(ascending=False).head(10)
+hb_by_agency_rev = top_k(rollup(cube_hb, 'Search Name')['Room Revenue'], 10)
 axes[1, 0].barh(range(len(hb_by_agency_rev)), hb_by_agency_rev.values, alpha=0.8, color='green')
 axes[1, 0].set_yticks(range(len(hb_by_agency_rev)))
 axes[1, 0].set_yticklabels(hb_by_agency_rev.index, fontsize=9)
@@ -118,7 +125,7 @@ axes[1, 0].set_title('Top 10 Agencies by Half Board Revenue')
 axes[1, 0].invert_yaxis()
 
 # HB Rate Codes Distribution
-hb_by_rate = df_hb.groupby('Rate Code')['Room Revenue'].sum().sort_values(ascending=False).head(10)
+hb_by_rate = top_k(rollup(cube_hb, 'Rate Code')['Room Revenue'], 10)
 axes[1, 1].barh(range(len(hb_by_rate)), hb_by_rate.values, alpha=0.8, color='purple')
 axes[1, 1].set_yticks(range(len(hb_by_rate)))
 axes[1, 1].set_yticklabels(hb_by_rate.index, fontsize=9)
@@ -138,10 +145,7 @@ fig, axes = plt.subplots(2, 2, figsize=(16, 12))
 fig.suptitle('Multivariate Analysis - Travel Agency & Rate Code Performance', fontsize=16, fontweight='bold')
 
 # Top 15 Agencies by Revenue
-agency_stats = df.groupby('Search Name').agg({
-    'Room Nights': 'sum',
-    'Room Revenue': 'sum'
-}).sort_values('Room Revenue', ascending=False).head(15)
+agency_stats = top_k(rollup(cube, 'Search Name')[['Room Nights', 'Room Revenue']], 15, 'Room Revenue')
 
 axes[0, 0].barh(range(len(agency_stats)), agency_stats['Room Revenue'].values, alpha=0.8)
 axes[0, 0].set_yticks(range(len(agency_stats)))
@@ -151,10 +155,7 @@ axes[0, 0].set_title('Top 15 Travel Agencies by Total Revenue')
 axes[0, 0].invert_yaxis()
 
 # Top 15 Rate Codes by Revenue
-rate_stats = df.groupby('Rate Code').agg({
-    'Room Nights': 'sum',
-    'Room Revenue': 'sum'
-}).sort_values('Room Revenue', ascending=False).head(15)
+rate_stats = top_k(rollup(cube, 'Rate Code')[['Room Nights', 'Room Revenue']], 15, 'Room Revenue')
 
 axes[0, 1].barh(range(len(rate_stats)), rate_stats['Room Revenue'].values, alpha=0.8, color='coral')
 axes[0, 1].set_yticks(range(len(rate_stats)))
@@ -164,10 +165,7 @@ axes[0, 1].set_title('Top 15 Rate Codes by Total Revenue')
 axes[0, 1].invert_yaxis()
 
 # Scatter: Room Nights vs Revenue by Agency
-agency_scatter = df.groupby('Search Name').agg({
-    'Room Nights': 'sum',
-    'Room Revenue': 'sum'
-})
+agency_scatter = rollup(cube, 'Search Name')[['Room Nights', 'Room Revenue']]
 axes[1, 0].scatter(agency_scatter['Room Nights'], agency_scatter['Room Revenue'], alpha=0.6, s=100)
 axes[1, 0].set_xlabel('Total Room Nights')
 axes[1, 0].set_ylabel('Total Revenue (AED)')
@@ -175,7 +173,7 @@ axes[1, 0].set_title('Agency Performance: Room Nights vs Revenue')
 axes[1, 0].grid(alpha=0.3)
 
 # Top Agency-Rate Code Combinations
-agency_rate = df.groupby(['Search Name', 'Rate Code'])['Room Revenue'].sum().sort_values(ascending=False).head(10)
+agency_rate = top_k(rollup(cube, ['Search Name', 'Rate Code'])['Room Revenue'], 10)
 combo_labels = [f"{agency}\n{rate}" for agency, rate in agency_rate.index]
 axes[1, 1].barh(range(len(agency_rate)), agency_rate.values, alpha=0.8, color='teal')
 axes[1, 1].set_yticks(range(len(agency_rate)))
@@ -197,7 +195,7 @@ fig.suptitle('CIS Market Analysis - Half Board Performance', fontsize=16, fontwe
 
 # CIS Rate Codes Performance
 if len(df_cis_hb) > 0:
-    cis_rate_perf = df_cis_hb.groupby('Rate Code').agg({
+    cis_rate_perf = df_cis_hb.groupby('Rate Code', observed=True).agg({
         'Room Nights': 'sum',
         'Room Revenue': 'sum'
     }).sort_values('Room Revenue', ascending=False)
@@ -215,7 +213,7 @@ if len(df_cis_hb) > 0:
     axes[0, 1].set_title('CIS Rate Codes Room Nights (Half Board)')
 
     # CIS Agencies Performance
-    cis_agency_perf = df_cis_hb.groupby('Search Name').agg({
+    cis_agency_perf = df_cis_hb.groupby('Search Name', observed=True).agg({
         'Room Nights': 'sum',
         'Room Revenue': 'sum'
     }).sort_values('Room Revenue', ascending=False)
@@ -228,7 +226,7 @@ if len(df_cis_hb) > 0:
     axes[1, 0].invert_yaxis()
 
     # Avg Rate Comparison
-    cis_avg_rates = df_cis_hb.groupby('Rate Code').apply(
+    cis_avg_rates = df_cis_hb.groupby('Rate Code', observed=True).apply(
         lambda x: (x['Room Revenue'].sum() / x['Room Nights'].sum())
     ).sort_values(ascending=False)
 
@@ -253,8 +251,8 @@ plt.close()
 # 5. CORRELATION HEATMAP
 # ============================================================================
 fig, ax = plt.subplots(1, 1, figsize=(10, 8))
-numeric_cols = ['Room Nights', 'Room Revenue', 'Avg_Rate_Per_Night']
-correlation_matrix = df[numeric_cols].corr()
+# Pooled from cached co-moment sums per HB flag and market segment
+correlation_matrix = pearson(load_comoments())
 
 sns.heatmap(correlation_matrix, annot=True, fmt='.3f', cmap='coolwarm',
             square=True, linewidths=1, cbar_kws={"shrink": 0.8}, ax=ax)
@@ -304,7 +302,7 @@ ax3.set_title('Half Board Revenue Contribution')
 
 # Top Agencies - Room Nights
 ax4 = fig.add_subplot(gs[1, :])
-top_agencies = df_hb.groupby('Search Name')['Room Nights'].sum().sort_values(ascending=False).head(15)
+top_agencies = top_k(df_hb.groupby('Search Name', observed=True)['Room Nights'].sum(), 15)
 ax4.barh(range(len(top_agencies)), top_agencies.values, alpha=0.8)
 ax4.set_yticks(range(len(top_agencies)))
 ax4.set_yticklabels(top_agencies.index, fontsize=9)
@@ -315,7 +313,7 @@ ax4.invert_yaxis()
 # CIS Performance
 ax5 = fig.add_subplot(gs[2, 0])
 if len(df_cis_hb) > 0:
-    cis_summary = df_cis_hb.groupby('Rate Code')['Room Revenue'].sum().sort_values(ascending=False)
+    cis_summary = df_cis_hb.groupby('Rate Code', observed=True)['Room Revenue'].sum().sort_values(ascending=False)
     ax5.bar(range(len(cis_summary)), cis_summary.values, alpha=0.8, color='purple')
     ax5.set_xticks(range(len(cis_summary)))
     ax5.set_xticklabels(cis_summary.index, rotation=45, ha='right', fontsize=9)
@@ -326,7 +324,7 @@ else:
 
 # Rate Code Performance
 ax6 = fig.add_subplot(gs[2, 1])
-top_rates_hb = df_hb.groupby('Rate Code')['Room Revenue'].sum().sort_values(ascending=False).head(10)
+top_rates_hb = top_k(df_hb.groupby('Rate Code', observed=True)['Room Revenue'].sum(), 10)
 ax6.bar(range(len(top_rates_hb)), top_rates_hb.values, alpha=0.8, color='teal')
 ax6.set_xticks(range(len(top_rates_hb)))
 ax6.set_xticklabels(top_rates_hb.index, rotation=45, ha='right', fontsize=8)
@@ -3,6 +3,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy import stats
+from hb_data import iter_batches, load_bookings, load_quarantine
+from hb_metrics import top_k
+from hb_stats import bootstrap_intervals, hb_tests
+from hb_sketch import (describe_moments, load_comoments, load_quantile_sketch, load_rank_sketch, pearson, sketch_quantiles,
+                       spearman, stream_moments)
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -11,7 +16,7 @@ sns.set_style("whitegrid")
 plt.rcParams['figure.figsize'] = (12, 8)
 
 # Read the data
-df = pd.read_excel('/home/gee_devops254/Downloads/Half Board/Half Board.xlsx')
+df = load_bookings()
 
 print("="*80)
 print("HALF BOARD STATISTICAL ANALYSIS")
@@ -26,13 +31,25 @@ print(f"Total Records: {len(df)}")
 print(f"Columns: {', '.join(df.columns)}")
 print(f"\nMissing Values:\n{df.isnull().sum()}")
 
+# Summary lines and invalid bookings are held back by the loader
+quarantined = load_quarantine()
+print(f"\nQuarantined Records: {len(quarantined)}")
+for reason, count in quarantined['Reason'].value_counts(sort=False).items():
+    if count:
+        print(f"  {reason}: {count}")
+
 # Filter Half Board records (case insensitive) - looking for "Halfboard" or "Half Board"
-df_hb = df[df['Product (Descriptions)'].str.contains('Halfboard|Half Board', case=False, na=False)]
+df_hb = df[df['Has_HB']]
 print(f"\nTotal Half Board Records: {len(df_hb)} out of {len(df)} ({len(df_hb)/len(df)*100:.1f}%)")
 
 # Also show what we found
 print(f"\nHalf Board Product Types Found:")
-print(df_hb['Product (Descriptions)'].value_counts())
+print(df_hb['Product (Descriptions)'].cat.remove_unused_categories().value_counts())
+
+# Meal plans and supplement prices parsed from the product strings
+print(f"\nMeal Plan Mix:\n{df['Meal_Plan'].value_counts()}")
+print(f"\nHB Supplement per Night (AED): mean {df_hb['HB_Supplement'].mean():.2f}, "
+      f"range {df_hb['HB_Supplement'].min():.0f}-{df_hb['HB_Supplement'].max():.0f}")
 
 # ============================================================================
 # UNIVARIATE ANALYSIS
@@ -41,28 +58,40 @@ print("\n\n" + "="*80)
 print("2. UNIVARIATE ANALYSIS - ALL DATA")
 print("="*80)
 
+# One streamed pass accumulates every moment statistic for the three columns
+univariate_cols = ['Room Nights', 'Room Revenue', 'Avg_Rate_Per_Night']
+univariate = describe_moments(stream_moments(iter_batches(columns=univariate_cols), univariate_cols))
+# Quartiles from the cached quantile sketch, within 1% of the exact values
+sketch = load_quantile_sketch()
+quartiles = pd.DataFrame({col: sketch_quantiles(sketch, col, [0.25, 0.5, 0.75]) for col in univariate_cols})
+
+def describe_column(col):
+    """describe()-style summary from the accumulated moments and sketch quartiles"""
+    m = univariate.loc[col]
+    return pd.Series([m['count'], m['mean'], m['std'], m['min'], *quartiles[col], m['max']],
+                     index=['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max'], name=col)
+
 print("\n2.1 ROOM NIGHTS STATISTICS")
 print("-"*80)
-print(df['Room Nights'].describe())
-print(f"\nSkewness: {df['Room Nights'].skew():.3f}")
-print(f"Kurtosis: {df['Room Nights'].kurtosis():.3f}")
-print(f"Variance: {df['Room Nights'].var():.3f}")
-print(f"Coefficient of Variation: {(df['Room Nights'].std()/df['Room Nights'].mean())*100:.2f}%")
+print(describe_column('Room Nights'))
+print(f"\nSkewness: {univariate.loc['Room Nights', 'skew']:.3f}")
+print(f"Kurtosis: {univariate.loc['Room Nights', 'kurtosis']:.3f}")
+print(f"Variance: {univariate.loc['Room Nights', 'var']:.3f}")
+print(f"Coefficient of Variation: {(univariate.loc['Room Nights', 'std']/univariate.loc['Room Nights', 'mean'])*100:.2f}%")
 
 print("\n2.2 ROOM REVENUE STATISTICS")
 print("-"*80)
-print(df['Room Revenue'].describe())
-print(f"\nSkewness: {df['Room Revenue'].skew():.3f}")
-print(f"Kurtosis: {df['Room Revenue'].kurtosis():.3f}")
-print(f"Variance: {df['Room Revenue'].var():.3f}")
-print(f"Coefficient of Variation: {(df['Room Revenue'].std()/df['Room Revenue'].mean())*100:.2f}%")
+print(describe_column('Room Revenue'))
+print(f"\nSkewness: {univariate.loc['Room Revenue', 'skew']:.3f}")
+print(f"Kurtosis: {univariate.loc['Room Revenue', 'kurtosis']:.3f}")
+print(f"Variance: {univariate.loc['Room Revenue', 'var']:.3f}")
+print(f"Coefficient of Variation: {(univariate.loc['Room Revenue', 'std']/univariate.loc['Room Revenue', 'mean'])*100:.2f}%")
 
 print("\n2.3 AVERAGE RATE PER NIGHT")
 print("-"*80)
-df['Avg_Rate_Per_Night'] = df['Room Revenue'] / df['Room Nights']
-print(df['Avg_Rate_Per_Night'].describe())
-print(f"\nSkewness: {df['Avg_Rate_Per_Night'].skew():.3f}")
-print(f"Kurtosis: {df['Avg_Rate_Per_Night'].kurtosis():.3f}")
+print(describe_column('Avg_Rate_Per_Night'))
+print(f"\nSkewness: {univariate.loc['Avg_Rate_Per_Night', 'skew']:.3f}")
+print(f"Kurtosis: {univariate.loc['Avg_Rate_Per_Night', 'kurtosis']:.3f}")
 
 print("\n2.4 CATEGORICAL VARIABLES FREQUENCY")
 print("-"*80)
@@ -97,12 +126,11 @@ print(f"Percentage of Total Revenue: {df_hb['Room Revenue'].sum()/df['Room Reven
 
 print("\n3.3 HALF BOARD AVERAGE RATE")
 print("-"*80)
-df_hb['Avg_Rate_Per_Night'] = df_hb['Room Revenue'] / df_hb['Room Nights']
 print(df_hb['Avg_Rate_Per_Night'].describe())
 
 print("\n3.4 TOP 10 AGENCIES BY HALF BOARD ROOM NIGHTS")
 print("-"*80)
-hb_by_agency = df_hb.groupby('Search Name').agg({
+hb_by_agency = df_hb.groupby('Search Name', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum'
 }).sort_values('Room Nights', ascending=False)
@@ -111,7 +139,7 @@ print(hb_by_agency.head(10))
 
 print("\n3.5 TOP 10 AGENCIES BY HALF BOARD REVENUE")
 print("-"*80)
-print(hb_by_agency.sort_values('Room Revenue', ascending=False).head(10))
+print(top_k(hb_by_agency, 10, 'Room Revenue'))
 
 # ============================================================================
 # MULTIVARIATE ANALYSIS - TRAVEL AGENCY AND RATE CODE
@@ -122,13 +150,18 @@ print("="*80)
 
 print("\n4.1 CORRELATION ANALYSIS")
 print("-"*80)
-numeric_cols = ['Room Nights', 'Room Revenue', 'Avg_Rate_Per_Night']
-correlation_matrix = df[numeric_cols].corr()
+# Pooled from cached co-moment sums per HB flag and market segment
+comoment_sums = load_comoments()
+correlation_matrix = pearson(comoment_sums)
 print(correlation_matrix)
+print("\nHalf Board Bookings Only:")
+print(pearson(comoment_sums[comoment_sums['Has_HB']]))
+print("\nRank Correlation (approximate Spearman):")
+print(spearman(load_rank_sketch()))
 
 print("\n4.2 TRAVEL AGENCY PERFORMANCE")
 print("-"*80)
-agency_stats = df.groupby('Search Name').agg({
+agency_stats = df.groupby('Search Name', observed=True).agg({
     'Room Nights': ['sum', 'mean', 'count'],
     'Room Revenue': ['sum', 'mean'],
 }).round(2)
@@ -140,7 +173,7 @@ print(agency_stats.head(15))
 
 print("\n4.3 RATE CODE PERFORMANCE")
 print("-"*80)
-ratecode_stats = df.groupby('Rate Code').agg({
+ratecode_stats = df.groupby('Rate Code', observed=True).agg({
     'Room Nights': ['sum', 'mean', 'count'],
     'Room Revenue': ['sum', 'mean'],
 }).round(2)
@@ -152,7 +185,7 @@ print(ratecode_stats.head(15))
 
 print("\n4.4 AGENCY-RATE CODE COMBINATION ANALYSIS")
 print("-"*80)
-agency_rate_combo = df.groupby(['Search Name', 'Rate Code']).agg({
+agency_rate_combo = df.groupby(['Search Name', 'Rate Code'], observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum'
 }).round(2)
@@ -180,7 +213,7 @@ print(f"CIS Half Board Penetration: {len(df_cis_hb)/len(df_cis)*100:.2f}%")
 
 print("\n5.2 CIS RATE CODES IN HALF BOARD")
 print("-"*80)
-cis_rate_analysis = df_cis_hb.groupby('Rate Code').agg({
+cis_rate_analysis = df_cis_hb.groupby('Rate Code', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum',
     'Search Name': 'count'
@@ -193,7 +226,7 @@ print(cis_rate_analysis)
 
 print("\n5.3 CIS MARKET BY TRAVEL AGENCY (HALF BOARD)")
 print("-"*80)
-cis_agency_analysis = df_cis_hb.groupby('Search Name').agg({
+cis_agency_analysis = df_cis_hb.groupby('Search Name', observed=True).agg({
     'Room Nights': 'sum',
     'Room Revenue': 'sum',
     'Rate Code': 'count'
@@ -232,13 +265,22 @@ print("="*80)
 
 print("\n6.1 HALF BOARD vs NON-HALF BOARD COMPARISON")
 print("-"*80)
-df['Is_HalfBoard'] = df['Product (Descriptions)'].str.contains('Halfboard|Half Board', case=False, na=False)
-df_non_hb = df[~df['Is_HalfBoard']]
+df_non_hb = df[~df['Has_HB']]
 
 print("\nComparison of Average Rates:")
 print(f"Half Board Avg Rate: ${df_hb['Avg_Rate_Per_Night'].mean():.2f}")
 print(f"Non-Half Board Avg Rate: ${df_non_hb['Avg_Rate_Per_Night'].mean():.2f}")
 
+# Bootstrap intervals alongside the point values
+overall = bootstrap_intervals(df, processes=1).iloc[0]
+print("\n95% Bootstrap Confidence Intervals:")
+print(f"  HB Rate Premium: ${overall['HB Rate Premium (AED)']:.2f} "
+      f"(${overall['HB Rate Premium (AED) Low']:.2f} to ${overall['HB Rate Premium (AED) High']:.2f})")
+print(f"  HB Penetration: {overall['HB Penetration %']:.1f}% "
+      f"({overall['HB Penetration % Low']:.1f}% to {overall['HB Penetration % High']:.1f}%)")
+print(f"  HB Revenue Share: {overall['HB Revenue Share %']:.1f}% "
+      f"({overall['HB Revenue Share % Low']:.1f}% to {overall['HB Revenue Share % High']:.1f}%)")
+
 # T-test
 t_stat, p_value = stats.ttest_ind(df_hb['Avg_Rate_Per_Night'].dropna(),
                                    df_non_hb['Avg_Rate_Per_Night'].dropna())
@@ -258,12 +300,30 @@ print("\n6.2 ANOVA - RATE CODE COMPARISON (TOP 10)")
 print("-"*80)
 top_rate_codes = df['Rate Code'].value_counts().head(10).index
 df_top_rates = df[df['Rate Code'].isin(top_rate_codes)]
-rate_groups = [group['Avg_Rate_Per_Night'].dropna() for name, group in df_top_rates.groupby('Rate Code')]
+rate_groups = [group['Avg_Rate_Per_Night'].dropna() for name, group in df_top_rates.groupby('Rate Code', observed=True)]
 f_stat, p_value_anova = stats.f_oneway(*rate_groups)
 print(f"F-statistic: {f_stat:.4f}")
 print(f"P-value: {p_value_anova:.4f}")
 print(f"Significant difference across rate codes: {'Yes' if p_value_anova < 0.05 else 'No'} (α=0.05)")
 
+print("\n6.3 BOOTSTRAP INTERVALS BY AGENCY, RATE CODE AND MARKET")
+print("-"*80)
+intervals = pd.concat({dim: bootstrap_intervals(df, dim, processes=1)
+                       for dim in ['Search Name', 'Rate Code', 'Market_Segment']}, names=['Dimension', 'Group'])
+agency_intervals = intervals.loc['Search Name']
+print("\nHB Penetration % for the 10 Agencies with Most Bookings (95% CI):")
+print(top_k(agency_intervals, 10, 'Bookings')[['Bookings', 'HB Penetration %', 'HB Penetration % Low',
+                                                   'HB Penetration % High']].round(1).to_string())
+
+print("\n6.4 HB TESTS FOR EVERY AGENCY AND RATE CODE")
+print("-"*80)
+tests = hb_tests(df, processes=1)
+print(tests.groupby(['Dimension', 'Test'])[['Significant']].agg(['size', 'sum'])
+      .set_axis(['Groups Tested', 'Significant (BH, α=0.05)'], axis=1).to_string())
+print("\nLowest Adjusted P-Values:")
+print(top_k(tests, 10, 'Adjusted P-Value', ascending=True)[
+    ['Dimension', 'Group', 'Test', 'Method', 'Effect', 'Adjusted P-Value']].round(4).to_string(index=False))
+
 # ============================================================================
 # SUMMARY INSIGHTS
 # ============================================================================
@@ -281,7 +341,7 @@ print(f"• Half Board generates {hb_revenue/total_revenue*100:.1f}% of total re
 print(f"• Half Board accounts for {hb_nights/total_nights*100:.1f}% of room nights ({hb_nights:,} nights)")
 print(f"• Average Half Board rate: ${df_hb['Avg_Rate_Per_Night'].mean():.2f} vs Overall: ${df['Avg_Rate_Per_Night'].mean():.2f}")
 print(f"• Top HB Agency: {hb_by_agency.index[0]} with {hb_by_agency.iloc[0]['Room Nights']:.0f} room nights")
-print(f"• Top HB Rate Code: {df_hb.groupby('Rate Code')['Room Revenue'].sum().idxmax()}")
+print(f"• Top HB Rate Code: {df_hb.groupby('Rate Code', observed=True)['Room Revenue'].sum().idxmax()}")
 
 if len(df_cis_hb) > 0:
     print(f"\n• CIS Market in Half Board: {len(df_cis_hb)} bookings, ${df_cis_hb['Room Revenue'].sum():,.2f} revenue")
@@ -302,6 +362,8 @@ print("\nSaving detailed CSV reports...")
 hb_by_agency.to_csv('/home/gee_devops254/Downloads/Half Board/hb_agency_analysis.csv')
 agency_stats.to_csv('/home/gee_devops254/Downloads/Half Board/agency_performance.csv')
 ratecode_stats.to_csv('/home/gee_devops254/Downloads/Half Board/ratecode_performance.csv')
+intervals.to_csv('/home/gee_devops254/Downloads/Half Board/hb_bootstrap_intervals.csv')
+tests.to_csv('/home/gee_devops254/Downloads/Half Board/hb_hypothesis_tests.csv', index=False)
 if len(cis_rate_analysis) > 0:
     cis_rate_analysis.to_csv('/home/gee_devops254/Downloads/Half Board/cis_market_analysis.csv')
     cis_agency_analysis.to_csv('/home/gee_devops254/Downloads/Half Board/cis_agency_analysis.csv')
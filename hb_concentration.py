@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+# Concentration of a measure across the labels of one dimension, e.g. HB
+# revenue across agencies. pareto() sorts once and keeps prefix sums; each
+# question after that is a lookup or a binary search on them. With no total
+# (no labels, or all zero) there is nothing to concentrate: labels_for_share()
+# gives 0 and the ratios give NaN.
+
+
+def pareto(values):
+    """Labels in descending order of a non-negative measure, with prefix sums
+
+    `values` is a Series indexed by label, such as a column of a cube
+    rollup; ties keep their input order. Returns Value, Cumulative,
+    Cumulative % of the total (NaN without a total), Cumulative Squares
+    and Lorenz Sum, the running sum of Cumulative, per label.
+    """
+    values = values.astype('float64')
+    if (values < 0).any():
+        raise ValueError('concentration needs non-negative values')
+    ordered = values.sort_values(ascending=False, kind='stable')
+    cumulative = ordered.cumsum()
+    total = cumulative.iloc[-1] if len(cumulative) else 0.0
+    return pd.DataFrame({
+        'Value': ordered,
+        'Cumulative': cumulative,
+        'Cumulative %': cumulative / total * 100 if total > 0 else np.nan,
+        'Cumulative Squares': (ordered ** 2).cumsum(),
+        'Lorenz Sum': cumulative.cumsum(),
+    })
+
+
+def _total(table, column='Cumulative'):
+    return table[column].iloc[-1] if len(table) else 0.0
+
+
+def labels_for_share(table, share):
+    """Fewest labels that together hold at least `share` (0-1] of the total"""
+    total = _total(table)
+    if total == 0:
+        return 0
+    cumulative = table['Cumulative'].to_numpy()
+    # Tolerate rounding in the prefix sums when share is exactly reached
+    position = np.searchsorted(cumulative, share * total * (1 - 1e-12), side='left')
+    return int(min(position + 1, len(cumulative)))
+
+
+def top_share(table, n):
+    """Fraction of the total held by the `n` largest labels"""
+    total = _total(table)
+    if total == 0:
+        return np.nan
+    if n <= 0:
+        return 0.0
+    return table['Cumulative'].iloc[min(n, len(table)) - 1] / total
+
+
+def hhi(table):
+    """Herfindahl-Hirschman index on the 0-10,000 scale"""
+    total = _total(table)
+    return _total(table, 'Cumulative Squares') / total ** 2 * 10000 if total > 0 else np.nan
+
+
+def gini(table):
+    """Gini coefficient: 0 when every label holds the same, (n - 1) / n when one holds everything"""
+    total = _total(table)
+    if total == 0:
+        return np.nan
+    n = len(table)
+    return (2 * _total(table, 'Lorenz Sum') / total - n - 1) / n
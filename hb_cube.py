@@ -0,0 +1,232 @@
+import argparse
+import hashlib
+import os
+from functools import reduce
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from scipy import sparse
+from hb_data import (CACHE_DIR, SOURCE_FILE, cache_path, derive_columns, iter_batches, read_changes, record_changes,
+                     rules_version, write_atomic)
+from hb_metrics import top_k
+
+# Additive booking cube. Report tables are rollups of this one small table
+# instead of fresh scans of the bookings.
+CUBE_DIMENSIONS = ['Search Name', 'Rate Code', 'Has_HB', 'Market_Segment', 'Size_Bin']
+
+# Sums and counts only, so any rollup is a plain groupby sum. Averages are
+# ratios of these, e.g. Avg Rate = Rate Sum / Rate Count.
+CUBE_MEASURES = ['Bookings', 'Room Nights', 'Room Revenue', 'HB Bookings', 'Rate Sum', 'Rate Count']
+
+# Finest booking-size bins, as right-closed (low, high] room-night intervals.
+# Size_Bin holds the interval number. Every edge the reports bin on is
+# listed so their coarser bins can be rolled up from these.
+SIZE_EDGES = [0, 2, 4, 5, 7, 10, 14, 15, 20, 30, 50, 100, 999, 1000, np.inf]
+
+# Booking columns build_cube() reads
+CUBE_INPUTS = ['Search Name', 'Rate Code', 'Has_HB', 'Market_Segment', 'Room Nights', 'Room Revenue',
+               'Avg_Rate_Per_Night']
+
+
+def size_bin(nights):
+    """Size_Bin interval number for each booking length"""
+    return np.searchsorted(SIZE_EDGES, np.asarray(nights, dtype='float64'), side='left') - 1
+
+
+def build_cube(df):
+    """Sum the CUBE_MEASURES over every observed combination of CUBE_DIMENSIONS"""
+    rate = df['Avg_Rate_Per_Night']
+    frame = pd.DataFrame({
+        'Search Name': df['Search Name'],
+        'Rate Code': df['Rate Code'],
+        'Has_HB': df['Has_HB'],
+        'Market_Segment': df['Market_Segment'],
+        'Size_Bin': size_bin(df['Room Nights']).astype('int8'),
+        'Bookings': 1,
+        'Room Nights': df['Room Nights'].astype('int64'),
+        'Room Revenue': df['Room Revenue'],
+        'HB Bookings': df['Has_HB'].astype('int64'),
+        'Rate Sum': rate.fillna(0.0),
+        'Rate Count': rate.notna().astype('int64'),
+    })
+    # Keep rows with a missing agency or rate code so totals still add up
+    return frame.groupby(CUBE_DIMENSIONS, observed=True, dropna=False)[CUBE_MEASURES].sum().reset_index()
+
+
+def _cube_path(path, cache_dir):
+    layout = hashlib.sha256(repr((CUBE_DIMENSIONS, CUBE_MEASURES, SIZE_EDGES)).encode()).hexdigest()[:12]
+    return f"{os.path.splitext(cache_path(path, cache_dir))[0]}.cube-{rules_version()}-{layout}.feather"
+
+
+def load_cube(path=SOURCE_FILE, cache_dir=CACHE_DIR):
+    """Cube for an extract, built on first use and cached next to its Feather copy
+
+    The cube is folded batch by batch from iter_batches(), so the bookings
+    are never all in memory at once. The cache follows the extract's
+    recorded changes, so the cube always sums the same bookings as
+    load_bookings().
+    """
+    if not os.path.isfile(path):
+        return stream_cube(iter_batches(path, cache_dir=cache_dir, columns=CUBE_INPUTS))
+    cached = _cube_path(path, cache_dir)
+    if not os.path.exists(cached):
+        cube = stream_cube(iter_batches(path, cache_dir=cache_dir, columns=CUBE_INPUTS))
+        write_atomic(pa.Table.from_pandas(cube, preserve_index=False), cached)
+    return feather.read_table(cached).to_pandas()
+
+
+def _union_categories(frames, col):
+    categories = []
+    for frame in frames:
+        categories += [c for c in frame[col].cat.categories if c not in categories]
+    return [frame[col].cat.set_categories(categories) for frame in frames]
+
+
+def merge_cubes(a, b):
+    """Add the cells of two cubes, e.g. built from separate batches of bookings"""
+    parts = [a.copy(), b.copy()]
+    for col in ['Search Name', 'Rate Code', 'Market_Segment']:
+        for part, values in zip(parts, _union_categories(parts, col)):
+            part[col] = values
+    merged = pd.concat(parts, ignore_index=True)
+    return merged.groupby(CUBE_DIMENSIONS, observed=True, dropna=False)[CUBE_MEASURES].sum().reset_index()
+
+
+def stream_cube(batches):
+    """build_cube() over an iterable of DataFrames, e.g. hb_data.iter_batches()"""
+    return reduce(merge_cubes, (build_cube(batch) for batch in batches))
+
+
+def apply_delta(cube, inserted=None, retracted=None):
+    """Add inserted bookings to the cube and take retracted ones out
+
+    Only the change set is aggregated; it is then merged into the existing
+    cells, so the cost follows the size of the change and of the cube,
+    never the booking history. Ratios are not stored, so with_ratios()
+    picks up the new sums on the next rollup. Cells left with no bookings
+    are dropped. Raises ValueError if a retraction takes a cell below zero,
+    e.g. when retracting a booking that was never inserted.
+    """
+    merged = cube
+    if inserted is not None and len(inserted):
+        merged = merge_cubes(merged, build_cube(inserted))
+    if retracted is not None and len(retracted):
+        removed = build_cube(retracted)
+        removed[CUBE_MEASURES] = -removed[CUBE_MEASURES]
+        merged = merge_cubes(merged, removed)
+    if merged is cube:
+        return cube.copy()
+
+    counts = ['Bookings', 'Room Nights', 'HB Bookings', 'Rate Count']
+    # Revenue sums may land a rounding error below zero when a cell empties
+    amounts = ['Room Revenue', 'Rate Sum']
+    if (merged[counts] < 0).any().any() or (merged[amounts] < -1e-6).any().any():
+        raise ValueError('retracted bookings are not all present in the cube')
+    return merged[merged['Bookings'] > 0].reset_index(drop=True)
+
+
+def update_cube(inserted=None, retracted=None, path=SOURCE_FILE, cache_dir=CACHE_DIR):
+    """Record extracts of inserted and retracted bookings against the main extract
+
+    The bookings go to the extract's change logs (see
+    hb_data.record_changes()), so every later load of `path` includes
+    them, and the cube is brought up to date with apply_delta() rather
+    than rebuilt. A retraction that does not match a current booking
+    exactly raises ValueError and nothing is recorded. Returns the cube.
+    """
+    changes = {'inserted': inserted, 'retracted': retracted}
+    changes = {kind: read_changes(extract) for kind, extract in changes.items() if extract}
+    derived = {kind: pd.concat([df, derive_columns(df)], axis=1) for kind, df in changes.items()}
+    cube = apply_delta(load_cube(path, cache_dir), derived.get('inserted'), derived.get('retracted'))
+    record_changes(path, changes.get('inserted'), changes.get('retracted'), cache_dir)
+    write_atomic(pa.Table.from_pandas(cube, preserve_index=False), _cube_path(path, cache_dir))
+    return cube
+
+
+def size_categories(cube, edges, labels):
+    """Map Size_Bin onto coarser bins, like pd.cut(nights, edges, labels=labels)
+
+    `edges` must be drawn from SIZE_EDGES. Bookings outside them get NaN.
+    """
+    if not set(edges) <= set(SIZE_EDGES):
+        raise ValueError(f"size bin edges must be drawn from SIZE_EDGES, got {list(edges)}")
+    upper = np.asarray(SIZE_EDGES)[cube['Size_Bin'].to_numpy() + 1]
+    coarse = np.searchsorted(edges, upper, side='left') - 1
+    coarse = np.where((coarse >= 0) & (coarse < len(edges) - 1), coarse, -1)
+    return pd.Categorical.from_codes(coarse, categories=labels, ordered=True)
+
+
+def rollup(cube, by, size_bins=None):
+    """Sum the cube's measures grouped by `by`
+
+    With `size_bins` as (edges, labels), a 'Size_Bin' entry in `by` groups
+    on those coarser bins instead. Groups with a missing key are dropped,
+    as in an ordinary groupby.
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    if size_bins is not None:
+        cube = cube.assign(Size_Bin=size_categories(cube, *size_bins))
+    return cube.groupby(by, observed=True)[CUBE_MEASURES].sum()
+
+
+def with_ratios(rolled):
+    """Add Avg Nights per Booking, HB Share and Avg Rate to a rollup"""
+    return rolled.assign(**{
+        'Avg Nights per Booking': rolled['Room Nights'] / rolled['Bookings'],
+        'HB Share': rolled['HB Bookings'] / rolled['Bookings'],
+        'Avg Rate': rolled['Rate Sum'] / rolled['Rate Count'],
+    })
+
+
+def sparse_matrix(cube, rows='Search Name', columns='Rate Code',
+                  measures=('Bookings', 'HB Bookings', 'Room Nights', 'Room Revenue')):
+    """Two-dimensional rollup as one sparse matrix per measure
+
+    Built from a single grouped pass over the cube. Returns a dict with the
+    'rows' and 'columns' labels and a CSR matrix for each measure; cells
+    without bookings are not stored.
+    """
+    rolled = rollup(cube, [rows, columns]).reset_index()
+    row_labels = pd.Index(cube[rows].cat.categories)
+    col_labels = pd.Index(cube[columns].cat.categories)
+    i = row_labels.get_indexer(rolled[rows])
+    j = col_labels.get_indexer(rolled[columns])
+    matrix = {'rows': row_labels, 'columns': col_labels}
+    for measure in measures:
+        values = rolled[measure].to_numpy(dtype='float64')
+        matrix[measure] = sparse.csr_matrix((values, (i, j)), shape=(len(row_labels), len(col_labels)))
+    return matrix
+
+
+def top_labels(matrix, axis, measure='Room Revenue', n=10):
+    """Row (axis=0) or column (axis=1) labels with the largest totals of `measure`"""
+    totals = np.asarray(matrix[measure].sum(axis=1 - axis)).ravel()
+    labels = matrix['rows'] if axis == 0 else matrix['columns']
+    return top_k(pd.Series(totals, index=labels), n).index
+
+
+def penetration(matrix, rows, columns):
+    """Dense HB penetration % for a slice of a sparse_matrix(); 0 where a cell has no bookings"""
+    i = matrix['rows'].get_indexer(rows)
+    j = matrix['columns'].get_indexer(columns)
+    bookings = matrix['Bookings'][i][:, j].toarray()
+    hb = matrix['HB Bookings'][i][:, j].toarray()
+    out = np.zeros_like(bookings)
+    np.divide(hb, bookings, out=out, where=bookings > 0)
+    return out * 100
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply booking changes to the Half Board cube')
+    parser.add_argument('--insert', help='xlsx or csv extract of new or amended bookings')
+    parser.add_argument('--retract', help='xlsx or csv extract of bookings to take out')
+    parser.add_argument('--source', default=SOURCE_FILE, help='extract the changes apply to')
+    args = parser.parse_args()
+    if not args.insert and not args.retract:
+        parser.error('nothing to apply; pass --insert and/or --retract')
+    try:
+        cube = update_cube(args.insert, args.retract, args.source)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Cube updated: {len(cube):,} cells, {cube['Bookings'].sum():,} bookings")
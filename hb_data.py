@@ -0,0 +1,514 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import glob
+import hashlib
+import os
+from openpyxl import load_workbook
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import hb_rules
+
+DATA_DIR = '/home/gee_devops254/Downloads/Half Board'
+
+# Source extract exported from the PMS. HB_SOURCE may point at another
+# workbook, a folder of extracts or a glob such as 'extracts/*.xlsx'.
+SOURCE_FILE = os.environ.get('HB_SOURCE', os.path.join(DATA_DIR, 'Half Board.xlsx'))
+
+
+def source_dir(source):
+    """Folder holding a source workbook, folder of extracts or glob"""
+    if os.path.isdir(source):
+        return os.path.abspath(source)
+    folder = os.path.dirname(os.path.abspath(source))
+    # A glob may have wildcards in its folder part too, e.g. 'hotels/*/may.xlsx'
+    while glob.has_magic(folder):
+        folder = os.path.dirname(folder)
+    return folder
+
+
+# Folder of the source, where the caches and the store live unless
+# HB_CACHE_DIR or HB_STORE_DIR say otherwise
+SOURCE_DIR = source_dir(SOURCE_FILE)
+
+# Converted copies, one file per source content hash
+CACHE_DIR = os.environ.get('HB_CACHE_DIR', os.path.join(SOURCE_DIR, '.hb_cache'))
+
+# Extract formats picked up when loading a folder
+EXTRACT_PATTERNS = ['*.xlsx', '*.csv']
+
+# Rows per batch when streaming the extract
+BATCH_SIZE = 50_000
+
+# Canonical column types applied at load time. Text columns are dictionary
+# encoded so filters and groupbys compare integer codes, not strings.
+SCHEMA = {
+    'Search Name': 'category',
+    'Rate Code': 'category',
+    'Product Codes': 'category',
+    'Product (Descriptions)': 'category',
+    'Room Nights': 'int32',
+    'Room Revenue': 'float64',
+    'Source': 'category',
+}
+
+# Columns computed by derive_columns() and cached next to the source data
+DERIVED_COLUMNS = ['Avg_Rate_Per_Night', 'Has_HB', 'Market_Segment'] + hb_rules.MEAL_COLUMNS
+
+# Rows that validate_bookings() keeps out of the analysis, in check order
+QUARANTINE_REASONS = [
+    'Summary row',
+    'Missing room nights',
+    'Zero or negative room nights',
+    'Missing revenue',
+    'Negative revenue',
+]
+
+# PMS summary lines such as 'Totals', 'Sub-total' or 'Grand Total'
+SUMMARY_PATTERN = r'^\s*(grand\s+|sub\s*-?\s*)?totals?\s*:?\s*$'
+
+# Bump when the layout of cached files changes so stale copies are rebuilt
+CACHE_VERSION = 3
+
+# Logs of bookings recorded against an extract after it was exported, kept
+# with its cache; inserts are added, then retractions taken out
+CHANGE_KINDS = ['inserted', 'retracted']
+
+
+# Digests already computed in this process, keyed by (path, size, mtime_ns)
+_HASHES = {}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Return the SHA-256 hex digest of a file's contents
+
+    The digest is remembered until the file's size or modification time
+    changes, so repeated loads hash each extract once per process.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _HASHES:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        _HASHES[key] = digest.hexdigest()
+    return _HASHES[key]
+
+
+def rules_version():
+    """Fingerprint of the classification rules in hb_rules.py"""
+    return file_hash(hb_rules.__file__)[:12]
+
+
+def _base_stem(path, cache_dir):
+    return os.path.join(cache_dir, f"{file_hash(path)}-v{CACHE_VERSION}")
+
+
+def _change_logs(path, cache_dir):
+    """Existing change logs of an extract, as {kind: path}"""
+    base = _base_stem(path, cache_dir)
+    logs = {kind: f"{base}.{kind}.feather" for kind in CHANGE_KINDS}
+    return {kind: log for kind, log in logs.items() if os.path.exists(log)}
+
+
+def _cache_stem(path, cache_dir):
+    """Cache stem for the current bookings of an extract
+
+    Once changes are recorded the stem also carries a fingerprint of the
+    change logs, so the Feather copy and every cache derived from it (cube,
+    sketches, derived columns) follow the recorded changes.
+    """
+    base = _base_stem(path, cache_dir)
+    logs = _change_logs(path, cache_dir)
+    if not logs:
+        return base
+    digest = hashlib.sha256(repr([(kind, file_hash(log)) for kind, log in logs.items()]).encode()).hexdigest()[:12]
+    return f"{base}-changes-{digest}"
+
+
+def cache_path(path=SOURCE_FILE, cache_dir=CACHE_DIR):
+    """Location of the Feather copy for the current contents of `path`"""
+    return f"{_cache_stem(path, cache_dir)}.feather"
+
+
+def apply_schema(df):
+    """Cast a raw extract to the canonical compact column types"""
+    df = df.copy()
+    for col, dtype in SCHEMA.items():
+        if col not in df.columns:
+            continue
+        if dtype == 'int32' and df[col].isna().any():
+            # Keep gaps visible rather than failing the cast
+            dtype = 'float32'
+        df[col] = df[col].astype(dtype)
+    return df
+
+
+def derive_columns(df):
+    """Compute the DERIVED_COLUMNS for an extract
+
+    The HB pattern, the market rules and the meal-plan parser are evaluated
+    once per distinct product string and rate code, then broadcast through
+    the categorical codes.
+    """
+    derived = pd.DataFrame(index=df.index)
+    derived['Avg_Rate_Per_Night'] = df['Room Revenue'] / df['Room Nights']
+
+    products = df['Product (Descriptions)'].astype('category')
+    is_hb = np.asarray(products.cat.categories.str.contains(hb_rules.HB_PATTERN, case=False), dtype=bool)
+    # Missing values have code -1, which picks the trailing entry
+    derived['Has_HB'] = np.append(is_hb, False)[products.cat.codes]
+
+    derived['Market_Segment'] = hb_rules.classify_rate_codes(df['Rate Code'])
+    meals = hb_rules.parse_meal_plans(df['Product (Descriptions)'], df.get('Product Codes'))
+    return pd.concat([derived, meals], axis=1)
+
+
+def validate_bookings(df):
+    """Split an extract into clean bookings and quarantined rows
+
+    Flags PMS summary rows, bookings without positive room nights (their
+    rate per night is undefined) and missing or negative revenue. Returns
+    (clean, quarantined); each quarantined row carries the first check it
+    failed in a Reason column.
+    """
+    names = df['Search Name'].astype('category')
+    is_summary = names.cat.categories.astype(str).str.match(SUMMARY_PATTERN, case=False)
+    # Missing names have code -1, which picks the trailing entry
+    is_summary = np.append(np.asarray(is_summary, dtype=bool), False)[names.cat.codes]
+    keys = [col for col in ['Search Name', 'Rate Code', 'Product Codes', 'Product (Descriptions)'] if col in df]
+
+    checks = [
+        is_summary | df[keys].isna().all(axis=1).to_numpy(),
+        df['Room Nights'].isna().to_numpy(),
+        (df['Room Nights'] <= 0).to_numpy(),
+        df['Room Revenue'].isna().to_numpy(),
+        (df['Room Revenue'] < 0).to_numpy(),
+    ]
+    reason = np.select(checks, QUARANTINE_REASONS, default='')
+    bad = reason != ''
+
+    quarantined = df[bad].copy()
+    quarantined['Reason'] = pd.Categorical(reason[bad], categories=QUARANTINE_REASONS)
+    clean = df[~bad].copy()
+    for col in clean.select_dtypes('category'):
+        clean[col] = clean[col].cat.remove_unused_categories()
+    # Re-applying the schema restores int32 nights once gaps are gone
+    return apply_schema(clean), quarantined
+
+
+def read_extract(path):
+    """Read one xlsx or csv extract and apply the canonical schema"""
+    if path.lower().endswith('.csv'):
+        df = pd.read_csv(path)
+    else:
+        df = pd.read_excel(path)
+    return apply_schema(df)
+
+
+def write_atomic(table, target):
+    """Write an Arrow table so readers never see a half-written file"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = f"{target}.{os.getpid()}.tmp"
+    # Uncompressed so later reads can memory-map the columns directly
+    feather.write_feather(table, tmp, compression='uncompressed')
+    os.replace(tmp, target)
+
+
+def _row_positions(rows, targets):
+    """Position in `rows` of a distinct, exactly equal row for each row of `targets`
+
+    Compares the SCHEMA columns of `targets`. Raises ValueError if any
+    target has no match left.
+    """
+    keys = [col for col in SCHEMA if col in targets.columns]
+    left = rows[keys].astype(object)
+    left['Occurrence'] = left.groupby(keys, dropna=False).cumcount()
+    left['Position'] = np.arange(len(left))
+    right = targets[keys].astype(object)
+    right['Occurrence'] = right.groupby(keys, dropna=False).cumcount()
+    matched = right.merge(left, on=keys + ['Occurrence'], how='left')
+    missing = int(matched['Position'].isna().sum())
+    if missing:
+        raise ValueError(f"{missing} retracted bookings do not match a current booking exactly")
+    return matched['Position'].to_numpy(dtype='int64')
+
+
+def _apply_changes(df, inserted=None, retracted=None):
+    """Bookings with `inserted` rows added and `retracted` rows taken out"""
+    if inserted is not None and len(inserted):
+        df = apply_schema(pd.concat([df, inserted], ignore_index=True))
+    if retracted is not None and len(retracted):
+        df = df.drop(df.index[_row_positions(df, retracted)]).reset_index(drop=True)
+        for col in df.select_dtypes('category'):
+            df[col] = df[col].cat.remove_unused_categories()
+    return df
+
+
+def _ensure_cached(path, cache_dir):
+    """Validate and cache an extract if needed, returning its cache stem"""
+    base = _base_stem(path, cache_dir)
+    if not os.path.exists(f"{base}.feather"):
+        clean, quarantined = validate_bookings(read_extract(path))
+        write_atomic(pa.Table.from_pandas(quarantined, preserve_index=False), f"{base}.quarantine.feather")
+        write_atomic(pa.Table.from_pandas(clean, preserve_index=False), f"{base}.feather")
+    stem = _cache_stem(path, cache_dir)
+    if not os.path.exists(f"{stem}.feather"):
+        logs = {kind: feather.read_table(log).to_pandas() for kind, log in _change_logs(path, cache_dir).items()}
+        current = _apply_changes(feather.read_table(f"{base}.feather").to_pandas(), *map(logs.get, CHANGE_KINDS))
+        write_atomic(feather.read_table(f"{base}.quarantine.feather"), f"{stem}.quarantine.feather")
+        write_atomic(pa.Table.from_pandas(current, preserve_index=False), f"{stem}.feather")
+    return stem
+
+
+def read_changes(path):
+    """Validated bookings from an extract of inserted or retracted bookings"""
+    return validate_bookings(read_extract(path))[0]
+
+
+def record_changes(path=SOURCE_FILE, inserted=None, retracted=None, cache_dir=CACHE_DIR):
+    """Add frames of inserted and retracted bookings to an extract's change logs
+
+    Every later load of `path` includes them. Each retracted booking must
+    equal a current booking exactly, an inserted one counting; otherwise
+    ValueError is raised and nothing is recorded. A new export of the
+    extract has its own, empty, logs.
+    """
+    if not os.path.isfile(path):
+        raise ValueError(f"changes can only be recorded against a single extract, not {path!r}")
+    stem = _ensure_cached(path, cache_dir)
+    current = _apply_changes(feather.read_table(f"{stem}.feather").to_pandas(), inserted, retracted)
+
+    base = _base_stem(path, cache_dir)
+    for kind, df in zip(CHANGE_KINDS, [inserted, retracted]):
+        if df is None or not len(df):
+            continue
+        log = f"{base}.{kind}.feather"
+        if os.path.exists(log):
+            df = apply_schema(pd.concat([feather.read_table(log).to_pandas(), df], ignore_index=True))
+        write_atomic(pa.Table.from_pandas(df, preserve_index=False), log)
+    stem = _cache_stem(path, cache_dir)
+    write_atomic(feather.read_table(f"{base}.quarantine.feather"), f"{stem}.quarantine.feather")
+    write_atomic(pa.Table.from_pandas(current, preserve_index=False), f"{stem}.feather")
+
+
+def _needed_columns(columns, filters):
+    """Columns to read: the projection plus anything the filters test"""
+    if columns is None:
+        return None
+    return list(dict.fromkeys(list(columns) + list(filters or {})))
+
+
+def _filter_mask(table, filters):
+    """Arrow mask keeping rows whose column matches a value or any of a list of values"""
+    mask = None
+    for col, values in filters.items():
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        test = pc.is_in(table[col], value_set=pa.array(list(values)))
+        mask = test if mask is None else pc.and_(mask, test)
+    return mask
+
+
+def _derived_path(stem):
+    return f"{stem}.derived-{rules_version()}.feather"
+
+
+def _read_derived(stem):
+    """Memory-map the cached DERIVED_COLUMNS for a cache stem, or None if they need rebuilding"""
+    derived_cached = _derived_path(stem)
+    if not os.path.exists(derived_cached):
+        return None
+    extra = feather.read_table(derived_cached, memory_map=True)
+    # A cache written before DERIVED_COLUMNS changed is rebuilt too
+    return extra if extra.column_names == DERIVED_COLUMNS else None
+
+
+def load_bookings(path=SOURCE_FILE, cache_dir=CACHE_DIR, derived=True, columns=None, filters=None, processes=1):
+    """Load the booking extract, parsing the workbook only when its contents change
+
+    Rows rejected by validate_bookings() are left out; see load_quarantine().
+    With `derived`, the DERIVED_COLUMNS are appended from their own cache
+    file, which is rebuilt when the source or the rules in hb_rules change.
+    `columns` limits the result to a projection and `filters` maps columns
+    to a value or list of values a row must match, e.g.
+    {'Search Name': 'TBO HOLIDAYS', 'Has_HB': True}. Both are applied to
+    the memory-mapped cache, so columns that are not asked for are never
+    decoded. A folder or glob is handed to load_extracts() with
+    `processes` workers; the default of one keeps unguarded report scripts
+    safe under the spawn and forkserver start methods.
+    """
+    if not os.path.isfile(path):
+        return load_extracts(path, cache_dir, processes, derived, columns, filters)
+    stem = _ensure_cached(path, cache_dir)
+    needed = _needed_columns(columns, filters)
+    table = feather.read_table(f"{stem}.feather", memory_map=True)
+    if needed is not None:
+        table = table.select([c for c in table.column_names if c in needed])
+
+    if derived and (needed is None or set(needed) - set(table.column_names)):
+        extra = _read_derived(stem)
+        if extra is None:
+            frame = derive_columns(feather.read_table(f"{stem}.feather").to_pandas())
+            write_atomic(pa.Table.from_pandas(frame, preserve_index=False), _derived_path(stem))
+            extra = _read_derived(stem)
+        for name in extra.column_names:
+            if needed is None or name in needed:
+                table = table.append_column(name, extra.column(name))
+
+    if filters:
+        table = table.filter(_filter_mask(table, filters))
+    if columns is not None:
+        table = table.select(list(columns))
+    df = table.to_pandas()
+    if filters:
+        for col in df.select_dtypes('category'):
+            df[col] = df[col].cat.remove_unused_categories()
+    return df
+
+
+def load_quarantine(path=SOURCE_FILE, cache_dir=CACHE_DIR):
+    """Rows held back from the analysis, with the Reason each one failed"""
+    if not os.path.isfile(path):
+        frames = []
+        for extract in find_extracts(path):
+            frame = load_quarantine(extract, cache_dir)
+            frame['Source'] = os.path.basename(extract)
+            frames.append(frame)
+        return apply_schema(pd.concat(frames, ignore_index=True))
+    stem = _ensure_cached(path, cache_dir)
+    return feather.read_table(f"{stem}.quarantine.feather").to_pandas()
+
+
+def find_extracts(source):
+    """Expand a folder, glob pattern or list of paths into extract files"""
+    if isinstance(source, (list, tuple)):
+        paths = list(source)
+    elif os.path.isdir(source):
+        paths = [p for pattern in EXTRACT_PATTERNS for p in glob.glob(os.path.join(source, pattern))]
+    else:
+        paths = glob.glob(source)
+    # Skip the lock files Excel and LibreOffice leave next to open workbooks
+    paths = sorted(p for p in paths if not os.path.basename(p).startswith(('~$', '.~lock')))
+    if not paths:
+        raise FileNotFoundError(f"no extracts found for {source!r}")
+    return paths
+
+
+def _load_tagged(path, cache_dir, derived=False, columns=None, filters=None):
+    df = load_bookings(path, cache_dir, derived, columns, filters)
+    df['Source'] = os.path.basename(path)
+    return df
+
+
+def load_extracts(source, cache_dir=CACHE_DIR, processes=None, derived=True, columns=None, filters=None):
+    """Load several extracts in a process pool and stack them in the shared schema
+
+    Each file goes through the per-file cache, so only new or changed files
+    are parsed. Rows are tagged with their file name in a Source column.
+    `columns` and `filters` work as in load_bookings(); a filter on Source
+    skips the other files entirely.
+    """
+    paths = find_extracts(source)
+    filters = dict(filters or {})
+    if 'Source' in filters:
+        sources = filters.pop('Source')
+        sources = set(sources) if isinstance(sources, (list, tuple, set)) else {sources}
+        paths = [p for p in paths if os.path.basename(p) in sources]
+        if not paths:
+            raise FileNotFoundError(f"no extracts in {source!r} match Source={sorted(sources)}")
+
+    full = columns is None and not filters
+    if full:
+        # Derive once over the stacked frame so categories are shared
+        per_file = (False, None, None)
+    else:
+        file_columns = None if columns is None else [c for c in columns if c != 'Source']
+        per_file = (derived, file_columns, filters)
+    if len(paths) == 1 or processes == 1:
+        frames = [_load_tagged(p, cache_dir, *per_file) for p in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            frames = list(pool.map(_load_tagged, paths, repeat(cache_dir), *map(repeat, per_file)))
+    df = apply_schema(pd.concat(frames, ignore_index=True))
+
+    if full:
+        return pd.concat([df, derive_columns(df)], axis=1) if derived else df
+    # Categoricals whose categories differ between files come back as objects
+    categorical = frames[0].select_dtypes('category').columns
+    df = df.astype({col: 'category' for col in categorical if df[col].dtype != 'category'})
+    return df if columns is None else df[list(columns)]
+
+
+def _iter_worksheet(path, batch_size):
+    """Walk the first worksheet in read-only mode, yielding row batches"""
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield pd.DataFrame.from_records(batch, columns=header)
+                batch = []
+        if batch:
+            yield pd.DataFrame.from_records(batch, columns=header)
+    finally:
+        wb.close()
+
+
+def _iter_file_batches(path, batch_size, cache_dir, derived, columns):
+    if not os.path.isfile(path):
+        for extract in find_extracts(path):
+            for batch in _iter_file_batches(extract, batch_size, cache_dir, derived, columns):
+                if columns is None or 'Source' in columns:
+                    batch['Source'] = pd.Categorical([os.path.basename(extract)] * len(batch))
+                yield batch if columns is None else batch[list(columns)]
+        return
+    keep = None if columns is None else [col for col in columns if col != 'Source']
+    stem = _cache_stem(path, cache_dir)
+    if not os.path.exists(f"{stem}.feather") and _change_logs(path, cache_dir):
+        # Recorded changes are applied to the cached copy, never to the raw workbook
+        stem = _ensure_cached(path, cache_dir)
+    if not os.path.exists(f"{stem}.feather"):
+        if path.lower().endswith('.csv'):
+            batches = pd.read_csv(path, chunksize=batch_size)
+        else:
+            batches = _iter_worksheet(path, batch_size)
+        for batch in batches:
+            batch = validate_bookings(apply_schema(batch))[0]
+            if derived:
+                batch = pd.concat([batch, derive_columns(batch)], axis=1)
+            yield batch if keep is None else batch[keep]
+        return
+    table = feather.read_table(f"{stem}.feather", memory_map=True)
+    extra = _read_derived(stem) if derived else None
+    if extra is not None:
+        for name in extra.column_names:
+            table = table.append_column(name, extra.column(name))
+        if keep is not None:
+            # Only decode the columns asked for
+            table = table.select(keep)
+    for start in range(0, table.num_rows, batch_size):
+        batch = table.slice(start, batch_size).to_pandas()
+        if derived and extra is None:
+            batch = pd.concat([batch, derive_columns(batch)], axis=1)
+        yield batch if keep is None else batch[keep]
+
+
+def iter_batches(path=SOURCE_FILE, batch_size=BATCH_SIZE, cache_dir=CACHE_DIR, derived=True, columns=None):
+    """Yield the booking extract as DataFrames of at most `batch_size` rows
+
+    Slices the memory-mapped Feather cache when one exists, taking the
+    derived columns from their cache file if it is current, otherwise
+    streams the workbook itself, so memory is bounded by the batch size.
+    Quarantined rows are dropped either way. `columns` limits each batch
+    to a projection. A folder or glob is streamed one extract after another.
+    """
+    yield from _iter_file_batches(path, batch_size, cache_dir, derived, columns)
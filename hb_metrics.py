@@ -0,0 +1,266 @@
+import argparse
+import numpy as np
+import pandas as pd
+from hb_data import load_bookings
+from hb_rules import MARKET_SEGMENTS
+
+# Grouped metrics shared by the workbook builders. Every function makes one
+# grouped pass over the bookings instead of re-filtering the frame per group.
+
+# Columns produced by agency_metrics(), in sheet order
+AGENCY_METRICS = [
+    'Total Room Nights',
+    'HB Room Nights',
+    'Non-HB Room Nights',
+    '% HB Nights',
+    'Total Revenue (AED)',
+    'HB Revenue (AED)',
+    'Non-HB Revenue (AED)',
+    '% HB Revenue',
+    'Total Bookings',
+    'HB Bookings',
+    'Avg Length of Stay (Overall)',
+    'Avg Length of Stay (HB)',
+    'Avg Length of Stay (Non-HB)',
+    'Avg Rate (Overall) AED',
+    'Avg Rate (HB) AED',
+    'Avg Rate (Non-HB) AED',
+    'Top Rate Code',
+    'Avg Nights per Booking',
+]
+
+# HB conversion opportunity: target share of room nights on HB and the F&B
+# revenue assumed per converted night
+TARGET_HB_PCT = 35
+HB_NIGHT_VALUE = 120
+
+# Priority Score thresholds, checked in order
+PRIORITY_LEVELS = [('HIGH', 7), ('MEDIUM', 4)]
+DEFAULT_PRIORITY = 'LOW'
+
+# Recommended tactics, checked in order; the first rule whose conditions all
+# hold wins. Conditions are strict: min_* means greater than, max_* less than.
+TACTIC_RULES = [
+    ('Urgent: Executive meeting + Commission incentive', {'min_nights': 500, 'max_hb_pct': 10}),
+    ('High Priority: Targeted HB promotion + Training', {'min_nights': 300, 'max_hb_pct': 20}),
+    ('Optimize: Upsell to premium HB packages', {'min_hb_pct': 50}),
+    ('Large Booking Leverage: Bundle HB in packages', {'min_avg_nights': 50}),
+]
+DEFAULT_TACTIC = 'Standard: Include in HB marketing campaign'
+
+
+def top_k(data, n, by=None, ascending=False):
+    """First `n` rows of `data` ranked by `by`, without sorting the whole table
+
+    Same result as data.sort_values(by, ascending=ascending, kind='stable')
+    .head(n). np.partition picks the candidates on the first key in linear
+    time, keeping every row tied with the n-th, and only those are sorted
+    on all keys. `data` may be a DataFrame or a Series (leave `by` unset).
+    """
+    keys = [] if by is None else [by] if isinstance(by, str) else list(by)
+    order = list(ascending) if isinstance(ascending, (list, tuple)) else [ascending] * max(len(keys), 1)
+    if isinstance(data, pd.Series):
+        rank = lambda frame: frame.sort_values(ascending=order[0], kind='stable')
+        first = data
+    else:
+        rank = lambda frame: frame.sort_values(keys, ascending=order, kind='stable')
+        first = data[keys[0]]
+    if n <= 0:
+        return data.iloc[:0]
+    if len(data) <= n:
+        return rank(data)
+
+    # Smaller is better after this; missing values rank last as in sort_values
+    key = first.to_numpy(dtype='float64', na_value=np.nan)
+    key = np.where(np.isnan(key), np.inf, key if order[0] else -key)
+    cutoff = np.partition(key, n - 1)[n - 1]
+    return rank(data.iloc[np.flatnonzero(key <= cutoff)]).head(n)
+
+
+def top_rate_codes(df, by='Search Name'):
+    """Most frequent Rate Code per group, ties going to the first code in sort order"""
+    counts = df.groupby([by, 'Rate Code'], observed=True).size().rename('Count').reset_index()
+    counts = counts.sort_values([by, 'Count', 'Rate Code'], ascending=[True, False, True], kind='stable')
+    return counts.drop_duplicates(by).set_index(by)['Rate Code']
+
+
+def agency_metrics(df, by='Search Name'):
+    """HB and non-HB volume, revenue, rate and stay metrics per agency
+
+    Returns one row per value of `by` with the AGENCY_METRICS columns.
+    HB and non-HB averages are 0 for agencies without such bookings, and
+    Top Rate Code is 'N/A' when an agency has no rate codes.
+    """
+    hb = df['Has_HB']
+    frame = df.assign(
+        _hb_nights=df['Room Nights'].where(hb, 0),
+        _hb_revenue=df['Room Revenue'].where(hb, 0.0),
+        _non_hb_revenue=df['Room Revenue'].where(~hb, 0.0),
+        _hb_stay=df['Room Nights'].where(hb),
+        _non_hb_stay=df['Room Nights'].where(~hb),
+        _hb_rate=df['Avg_Rate_Per_Night'].where(hb),
+        _non_hb_rate=df['Avg_Rate_Per_Night'].where(~hb),
+    )
+    grouped = frame.groupby(by, observed=True).agg(**{
+        'Total Room Nights': ('Room Nights', 'sum'),
+        'HB Room Nights': ('_hb_nights', 'sum'),
+        'Total Revenue (AED)': ('Room Revenue', 'sum'),
+        'HB Revenue (AED)': ('_hb_revenue', 'sum'),
+        'Non-HB Revenue (AED)': ('_non_hb_revenue', 'sum'),
+        'Total Bookings': ('Room Nights', 'size'),
+        'HB Bookings': ('Has_HB', 'sum'),
+        'Avg Length of Stay (Overall)': ('Room Nights', 'mean'),
+        'Avg Length of Stay (HB)': ('_hb_stay', 'mean'),
+        'Avg Length of Stay (Non-HB)': ('_non_hb_stay', 'mean'),
+        'Avg Rate (Overall) AED': ('Avg_Rate_Per_Night', 'mean'),
+        'Avg Rate (HB) AED': ('_hb_rate', 'mean'),
+        'Avg Rate (Non-HB) AED': ('_non_hb_rate', 'mean'),
+    })
+
+    has_hb = grouped['HB Bookings'] > 0
+    has_non_hb = grouped['Total Bookings'] > grouped['HB Bookings']
+    for col, present in [('Avg Length of Stay (HB)', has_hb), ('Avg Length of Stay (Non-HB)', has_non_hb),
+                         ('Avg Rate (HB) AED', has_hb), ('Avg Rate (Non-HB) AED', has_non_hb)]:
+        grouped[col] = grouped[col].where(present, 0)
+
+    nights = grouped['Total Room Nights']
+    revenue = grouped['Total Revenue (AED)']
+    grouped['Non-HB Room Nights'] = nights - grouped['HB Room Nights']
+    grouped['% HB Nights'] = (grouped['HB Room Nights'] / nights * 100).where(nights > 0, 0)
+    grouped['% HB Revenue'] = (grouped['HB Revenue (AED)'] / revenue * 100).where(revenue > 0, 0)
+    grouped['Top Rate Code'] = top_rate_codes(df, by).astype(object).reindex(grouped.index).fillna('N/A')
+    grouped['Avg Nights per Booking'] = grouped['Avg Length of Stay (Overall)']
+    return grouped[AGENCY_METRICS]
+
+
+def _rule_mask(conditions, nights, hb_pct, avg_nights):
+    values = {'nights': nights, 'hb_pct': hb_pct, 'avg_nights': avg_nights}
+    mask = np.ones(len(nights), dtype=bool)
+    for key, threshold in conditions.items():
+        bound, field = key.split('_', 1)
+        mask &= values[field] > threshold if bound == 'min' else values[field] < threshold
+    return mask
+
+
+def opportunity_scores(df, by='Search Name', target_pct=TARGET_HB_PCT, night_value=HB_NIGHT_VALUE,
+                       tactic_rules=TACTIC_RULES):
+    """HB conversion opportunity, priority and recommended tactic per agency
+
+    Scores are array expressions over one grouped pass: Volume Score is
+    room nights / 100 and Opportunity Score the non-HB share / 10, both
+    capped at 10, and Priority Score is their mean. Incremental nights and
+    revenue assume each agency reaches `target_pct` HB nights at
+    `night_value` AED per night. Rows are in `by` order, unsorted.
+    """
+    hb = df['Has_HB']
+    grouped = df.assign(_hb_nights=df['Room Nights'].where(hb, 0)).groupby(by, observed=True).agg(
+        nights=('Room Nights', 'sum'),
+        hb_nights=('_hb_nights', 'sum'),
+        avg_nights=('Room Nights', 'mean'),
+    )
+    nights = grouped['nights'].to_numpy()
+    hb_nights = grouped['hb_nights'].to_numpy()
+    avg_nights = grouped['avg_nights'].to_numpy()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hb_pct = np.where(nights > 0, hb_nights / nights * 100, 0)
+    incremental_nights = nights * (target_pct / 100) - hb_nights
+    volume_score = np.minimum(nights / 100, 10)
+    opportunity_score = (100 - hb_pct) / 10
+    priority_score = (volume_score + opportunity_score) / 2
+
+    priority = np.select([priority_score >= level for _, level in PRIORITY_LEVELS],
+                         [name for name, _ in PRIORITY_LEVELS], default=DEFAULT_PRIORITY)
+    tactic = np.select([_rule_mask(conditions, nights, hb_pct, avg_nights) for _, conditions in tactic_rules],
+                       [name for name, _ in tactic_rules], default=DEFAULT_TACTIC)
+
+    return pd.DataFrame({
+        'Total Room Nights': nights,
+        'Current HB Nights': hb_nights,
+        'Current HB %': hb_pct,
+        f"Target HB % ({target_pct:g}%)": float(target_pct),
+        'Gap to Target (%)': np.maximum(target_pct - hb_pct, 0),
+        'Potential HB Nights': np.maximum(incremental_nights, 0),
+        'Est. Incremental F&B Revenue (AED)': np.maximum(incremental_nights * night_value, 0),
+        'Volume Score (1-10)': volume_score,
+        'Opportunity Score (1-10)': np.minimum(opportunity_score, 10),
+        'Priority Score': priority_score,
+        'Action Priority': priority,
+        'Avg Nights per Booking': avg_nights,
+        'Recommended Tactic': tactic,
+    }, index=grouped.index)
+
+
+def scenario_grid(df, targets, prices, market_overrides=None, by='Search Name'):
+    """Incremental F&B revenue per agency for every target x price scenario
+
+    `targets` are HB shares of room nights in percent and `prices` AED per
+    HB night. `market_overrides` maps a market segment to a fixed
+    {'target': ..., 'price': ...} that replaces the grid value for that
+    market's bookings in every scenario. Each agency's gap is summed over
+    its markets before clipping at zero, as in opportunity_scores().
+
+    The whole agency x target x price tensor comes from one broadcast and
+    one contraction. Returns agencies as rows and a (target, price)
+    column MultiIndex.
+    """
+    targets = np.atleast_1d(np.asarray(targets, dtype='float64'))
+    prices = np.atleast_1d(np.asarray(prices, dtype='float64'))
+    hb = df['Has_HB']
+    cells = df.assign(_hb_nights=df['Room Nights'].where(hb, 0)).groupby(
+        [by, 'Market_Segment'], observed=True)[['Room Nights', '_hb_nights']].sum()
+    table = cells.unstack('Market_Segment', fill_value=0)
+    markets = table['Room Nights'].columns
+    nights = table['Room Nights'].to_numpy(dtype='float64')
+    hb_nights = table['_hb_nights'][markets].to_numpy(dtype='float64')
+
+    market_targets = np.tile(targets, (len(markets), 1))
+    market_prices = np.tile(prices, (len(markets), 1))
+    for market, override in (market_overrides or {}).items():
+        if market not in MARKET_SEGMENTS:
+            raise ValueError(f"unknown market segment {market!r}")
+        if set(override) - {'target', 'price'}:
+            raise ValueError(f"market overrides take 'target' and 'price', got {sorted(override)}")
+        if market not in markets:
+            continue
+        row = markets.get_loc(market)
+        if 'target' in override:
+            market_targets[row] = override['target']
+        if 'price' in override:
+            market_prices[row] = override['price']
+
+    # (agency, market, target) gaps in nights, priced per market
+    gaps = nights[:, :, None] * (market_targets / 100)[None] - hb_nights[:, :, None]
+    revenue = np.maximum(np.einsum('amt,mp->atp', gaps, market_prices), 0)
+    columns = pd.MultiIndex.from_product([targets, prices], names=['Target HB %', 'HB Night Value (AED)'])
+    return pd.DataFrame(revenue.reshape(len(table), -1), index=table.index, columns=columns)
+
+
+def _parse_override(text):
+    """'CIS Markets:target=50,price=140' -> ('CIS Markets', {'target': 50.0, 'price': 140.0})"""
+    market, _, settings = text.rpartition(':')
+    if not market:
+        raise ValueError(f"override must look like MARKET:target=50,price=140, got {text!r}")
+    values = {}
+    for setting in settings.split(','):
+        key, _, value = setting.partition('=')
+        values[key.strip()] = float(value)
+    return market, values
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Total incremental HB revenue across target and price scenarios')
+    parser.add_argument('--targets', type=float, nargs='+', default=[TARGET_HB_PCT], help='HB share targets, %%')
+    parser.add_argument('--prices', type=float, nargs='+', default=[HB_NIGHT_VALUE], help='AED per HB night')
+    parser.add_argument('--override', action='append', default=[],
+                        help="fixed values for one market, e.g. 'CIS Markets:target=50,price=140'")
+    args = parser.parse_args()
+    try:
+        overrides = dict(_parse_override(text) for text in args.override)
+        df = load_bookings(columns=['Search Name', 'Room Nights', 'Has_HB', 'Market_Segment'])
+        grid = scenario_grid(df, args.targets, args.prices, overrides)
+    except ValueError as e:
+        parser.error(str(e))
+    totals = grid.sum().unstack('HB Night Value (AED)')
+    print('Incremental F&B revenue (AED) by target HB % (rows) and AED per HB night (columns)')
+    print(totals.map(lambda v: f"{v:,.0f}").to_string())
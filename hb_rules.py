@@ -0,0 +1,160 @@
+import re
+import numpy as np
+import pandas as pd
+
+# Classification rules shared by every analysis and chart script. Any edit to
+# this file invalidates the derived columns cached by hb_data.
+
+# Product descriptions that carry a half board component
+HB_PATTERN = 'Halfboard|Half Board'
+
+# Market segmentation from rate codes. Rules are checked in order and the
+# first match wins: (segment, substrings of the upper-cased code, exact codes)
+MARKET_RULES = [
+    ('CIS Markets', ['CIS'], []),
+    ('Luxembourg', ['MILUX'], []),
+    ('Universal/Multi-Market', ['BBWI', 'BBJN', 'BB-WI'], ['TOBB']),
+    ('Specific Market', ['ROWI'], []),
+    ('Secret Escapes', ['SSE', 'FSSE'], []),
+    ('Desert Gate', ['DG'], []),
+    ('Express/Quick', ['EX'], []),
+]
+OTHER_MARKET = 'Other'
+UNKNOWN_MARKET = 'Unknown'
+
+MARKET_SEGMENTS = [segment for segment, _, _ in MARKET_RULES] + [OTHER_MARKET, UNKNOWN_MARKET]
+
+
+def compile_market_rules(rules=MARKET_RULES):
+    """Turn the rule table into one (segment, regex) pair per rule"""
+    compiled = []
+    for segment, substrings, exact in rules:
+        alternatives = [re.escape(s) for s in substrings]
+        alternatives += [f"^{re.escape(code)}$" for code in exact]
+        compiled.append((segment, re.compile('|'.join(alternatives))))
+    return compiled
+
+
+_COMPILED_RULES = compile_market_rules()
+
+
+def classify_rate_codes(rate_codes):
+    """Market segment for each rate code, as a categorical over MARKET_SEGMENTS
+
+    The rules run once per distinct rate code and the result is broadcast
+    through the categorical codes, so the cost follows the size of the
+    rate-code vocabulary rather than the number of bookings.
+    """
+    codes = pd.Series(rate_codes).astype('category')
+    vocabulary = codes.cat.categories.astype(str).str.upper()
+    matches = [vocabulary.str.contains(pattern) for _, pattern in _COMPILED_RULES]
+    segments = np.select(matches, [segment for segment, _ in _COMPILED_RULES], default=OTHER_MARKET)
+    # Missing rate codes have code -1, which picks the trailing entry
+    lookup = np.append(segments.astype(object), UNKNOWN_MARKET)
+    return pd.Categorical(lookup[codes.cat.codes], categories=MARKET_SEGMENTS)
+
+
+# Meal-plan components: (column prefix, description pattern, product code prefix).
+# Each one gets a <prefix>_Supplement column with its AED price per night.
+MEAL_COMPONENTS = [
+    ('HB', r'half\s*board', 'HB'),
+    ('BF', r'breakfast', 'BF'),
+    ('LN', r'lunch', 'LN'),
+    ('DN', r'dinner', 'DN'),
+]
+ROOM_ONLY = 'Room Only'
+
+MEAL_COLUMNS = ['Meal_Plan'] + [f"{prefix}_Supplement" for prefix, _, _ in MEAL_COMPONENTS]
+
+_DESCRIPTION_PRICE = re.compile(r'AED\s*(\d+(?:\.\d+)?)', re.IGNORECASE)
+# Codes look like HBINCL, BFINCL40, HB79INC or -2*HBINCL (a quantity posting)
+_PRODUCT_CODE = re.compile(r'^(?:-?\d+\*)?([A-Z]{2})\D*(\d+(?:\.\d+)?)?', re.IGNORECASE)
+
+
+def _add_component(plan, prefix, price):
+    if price is None:
+        plan.setdefault(prefix, None)
+    else:
+        plan[prefix] = (plan.get(prefix) or 0.0) + price
+
+
+def parse_meal_description(description):
+    """Meal components and AED supplements in one product description
+
+    Returns {prefix: price}, with None for a component listed without a
+    price such as 'Breakfast Add on'. Repeated components are summed.
+    """
+    plan = {}
+    for item in str(description).split(','):
+        for prefix, pattern, _ in MEAL_COMPONENTS:
+            if re.search(pattern, item, re.IGNORECASE):
+                price = _DESCRIPTION_PRICE.search(item)
+                _add_component(plan, prefix, float(price.group(1)) if price else None)
+                break
+    return plan
+
+
+def parse_product_codes(codes):
+    """Meal components and AED supplements in a comma-separated product code list
+
+    Same shape as parse_meal_description(); posting quantities are ignored.
+    """
+    prefixes = {code: prefix for prefix, _, code in MEAL_COMPONENTS}
+    plan = {}
+    for token in str(codes).split(','):
+        match = _PRODUCT_CODE.match(token.strip())
+        if match is None or match.group(1).upper() not in prefixes:
+            continue
+        _add_component(plan, prefixes[match.group(1).upper()], float(match.group(2)) if match.group(2) else None)
+    return plan
+
+
+def _meal_frame(values, parser):
+    """Parse each distinct value once and broadcast back to one row per value
+
+    Returns the supplement prices and a boolean matrix of the components
+    present.
+    """
+    values = pd.Series(values).astype('category')
+    # Missing values have code -1, which picks the trailing empty plan
+    plans = [parser(value) for value in values.cat.categories] + [{}]
+    prefixes = [prefix for prefix, _, _ in MEAL_COMPONENTS]
+    prices = np.array([[plan.get(p, np.nan) for p in prefixes] for plan in plans], dtype='float64')
+    present = np.array([[p in plan for p in prefixes] for plan in plans], dtype=bool).reshape(-1, len(prefixes))
+    codes = values.cat.codes.to_numpy()
+    return prices[codes], present[codes]
+
+
+def parse_meal_plans(descriptions, codes=None):
+    """Meal_Plan label and <prefix>_Supplement prices for each booking
+
+    Descriptions and product codes are parsed once per distinct string and
+    broadcast through the categorical codes. Descriptions carry the prices;
+    codes fill in components and prices a description leaves out.
+    """
+    descriptions = pd.Series(descriptions)
+    prices, present = _meal_frame(descriptions, parse_meal_description)
+    if codes is not None:
+        code_prices, code_present = _meal_frame(codes, parse_product_codes)
+        prices = np.where(np.isnan(prices), code_prices, prices)
+        present |= code_present
+
+    # Label every combination of components once, then index by bitmask
+    prefixes = [prefix for prefix, _, _ in MEAL_COMPONENTS]
+    labels = ['+'.join(p for i, p in enumerate(prefixes) if mask >> i & 1) or ROOM_ONLY
+              for mask in range(1 << len(prefixes))]
+    masks = present.astype(np.int64) @ (1 << np.arange(len(prefixes)))
+    result = pd.DataFrame(prices, columns=MEAL_COLUMNS[1:], index=descriptions.index)
+    result.insert(0, 'Meal_Plan', pd.Categorical(np.array(labels, dtype=object)[masks]).remove_unused_categories())
+    return result
+
+
+# Identify markets from rate codes
+def identify_market(rate_code):
+    if pd.isna(rate_code):
+        return UNKNOWN_MARKET
+    rate_code = str(rate_code).upper()
+    for segment, pattern in _COMPILED_RULES:
+        if pattern.search(rate_code):
+            return segment
+    return OTHER_MARKET
@@ -0,0 +1,450 @@
+import hashlib
+import os
+from functools import reduce
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from hb_data import CACHE_DIR, SOURCE_FILE, cache_path, iter_batches, rules_version, write_atomic
+from hb_store import STORE_DIR, summarise
+
+# Mergeable summaries of the bookings. Each is a small DataFrame built from
+# one chunk (a batch, a partition, a worker's share) and combined with its
+# merge function, so statistics over any set of chunks never need the rows.
+
+# Count, mean, central moment sums M2-M4 and range per column
+MOMENT_FIELDS = ['count', 'mean', 'M2', 'M3', 'M4', 'min', 'max']
+
+# moments() of a column with no values
+EMPTY_MOMENTS = {'count': 0, 'mean': 0.0, 'M2': 0.0, 'M3': 0.0, 'M4': 0.0, 'min': np.inf, 'max': -np.inf}
+
+# Quantile sketches count values in logarithmic buckets, separately by each
+# of these dimensions rather than their cross product. Per column that is
+# at most (groups summed over the dimensions) x (buckets) rows, about 115
+# buckets per tenfold range of values at 1% accuracy, whatever the number
+# of bookings.
+SKETCH_DIMENSIONS = ['Search Name', 'Rate Code', 'Market_Segment', 'Has_HB']
+SKETCH_COLUMNS = ['Room Nights', 'Room Revenue', 'Avg_Rate_Per_Night']
+
+# Relative error of sketch quantiles: each is within 1% of a true order
+# statistic. Halving it roughly doubles the buckets kept.
+QUANTILE_ACCURACY = 0.01
+
+# Bucket number for values of zero or less
+ZERO_BUCKET = -2 ** 31
+
+# Distinct counts keep HyperLogLog registers of each column by the other
+# dimensions, e.g. agencies by rate code, market and HB flag. 2^12
+# registers give about 1.6% standard error, and small counts such as
+# agencies per rate code are near exact.
+DISTINCT_COLUMNS = ['Search Name', 'Rate Code']
+DISTINCT_DIMENSIONS = ['Search Name', 'Rate Code', 'Market_Segment', 'Has_HB']
+HLL_PRECISION = 12
+
+# Correlations come from co-moment sums per HB flag and market; any set of
+# these segments pools into one correlation matrix
+CORRELATION_COLUMNS = ['Room Nights', 'Room Revenue', 'Avg_Rate_Per_Night']
+CORRELATION_DIMENSIONS = ['Has_HB', 'Market_Segment']
+
+
+def moments(df, columns):
+    """MOMENT_FIELDS for each of `columns`, skipping missing values"""
+    x = df[list(columns)].to_numpy(dtype='float64')
+    present = ~np.isnan(x)
+    count = present.sum(axis=0)
+    with np.errstate(invalid='ignore'):
+        mean = np.where(count > 0, np.nansum(x, axis=0) / np.maximum(count, 1), 0.0)
+        dev = np.where(present, x - mean, 0.0)
+    dev2 = dev * dev
+    return pd.DataFrame({
+        'count': count,
+        'mean': mean,
+        'M2': dev2.sum(axis=0),
+        'M3': (dev2 * dev).sum(axis=0),
+        'M4': (dev2 * dev2).sum(axis=0),
+        'min': np.where(present, x, np.inf).min(axis=0, initial=np.inf),
+        'max': np.where(present, x, -np.inf).max(axis=0, initial=-np.inf),
+    }, index=pd.Index(list(columns)))
+
+
+def merge_moments(a, b):
+    """Combine two moments() frames with the pairwise update formulas of Chan and Pebay"""
+    index = a.index.union(b.index, sort=False)
+    a, b = a.reindex(index).fillna(EMPTY_MOMENTS), b.reindex(index).fillna(EMPTY_MOMENTS)
+    na, nb = a['count'], b['count']
+    n = na + nb
+    safe = n.where(n > 0, 1)
+    delta = b['mean'] - a['mean']
+    return pd.DataFrame({
+        'count': n.astype('int64'),
+        'mean': a['mean'] + delta * nb / safe,
+        'M2': a['M2'] + b['M2'] + delta ** 2 * na * nb / safe,
+        'M3': (a['M3'] + b['M3'] + delta ** 3 * na * nb * (na - nb) / safe ** 2
+               + 3 * delta * (na * b['M2'] - nb * a['M2']) / safe),
+        'M4': (a['M4'] + b['M4'] + delta ** 4 * na * nb * (na * na - na * nb + nb * nb) / safe ** 3
+               + 6 * delta ** 2 * (na * na * b['M2'] + nb * nb * a['M2']) / safe ** 2
+               + 4 * delta * (na * b['M3'] - nb * a['M3']) / safe),
+        'min': np.minimum(a['min'], b['min']),
+        'max': np.maximum(a['max'], b['max']),
+    })
+
+
+def stream_moments(batches, columns):
+    """moments() over an iterable of DataFrames, e.g. hb_data.iter_batches()"""
+    return reduce(merge_moments, (moments(batch, columns) for batch in batches))
+
+
+def store_moments(columns, store_dir=STORE_DIR, properties=None, periods=None):
+    """moments() across the selected store partitions, each summarised once and cached"""
+    columns = list(columns)
+    return summarise(f"moments-{columns}", lambda df: moments(df, columns), merge_moments,
+                     store_dir, properties, periods)
+
+
+def describe_moments(m):
+    """Count, mean, std, var, min, max, skew and excess kurtosis per column
+
+    Sample statistics with the same bias corrections as pandas' std(),
+    var(), skew() and kurtosis(); NaN where there are too few values.
+    """
+    n = m['count'].astype('float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (m['M2'] / (n - 1)).where(n > 1)
+        skew = (np.sqrt(n * (n - 1)) / (n - 2) * np.sqrt(n) * m['M3'] / m['M2'] ** 1.5).where((n > 2) & (m['M2'] > 0))
+        kurtosis = ((n + 1) * n * (n - 1) / ((n - 2) * (n - 3)) * m['M4'] / m['M2'] ** 2
+                    - 3 * (n - 1) ** 2 / ((n - 2) * (n - 3))).where((n > 3) & (m['M2'] > 0))
+    return pd.DataFrame({
+        'count': n,
+        'mean': m['mean'].where(n > 0),
+        'std': np.sqrt(var),
+        'var': var,
+        'min': m['min'].where(n > 0),
+        'max': m['max'].where(n > 0),
+        'skew': skew,
+        'kurtosis': kurtosis,
+    })
+
+
+def _log_bucket(x, accuracy):
+    """Bucket i holds values in (g^(i-1), g^i], g = (1 + accuracy) / (1 - accuracy)"""
+    gamma = (1 + accuracy) / (1 - accuracy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(x > 0, np.ceil(np.log(x) / np.log(gamma)), ZERO_BUCKET).astype('int64')
+
+
+def quantile_sketch(df, columns=SKETCH_COLUMNS, by=SKETCH_DIMENSIONS, accuracy=QUANTILE_ACCURACY):
+    """Log-bucketed value counts per group of each `by` dimension
+
+    Rows are (Dimension, *by, Column, Bucket, Count, Sum), with only the
+    Dimension's own column set; every dimension covers all the bookings.
+    Bucket i holds values in (g^(i-1), g^i] with g = (1 + accuracy) /
+    (1 - accuracy), as in DDSketch, so any value in a bucket, and their
+    mean Sum / Count, is within `accuracy` of every value it holds. Values
+    of zero or less go to ZERO_BUCKET. Count and Sum are additive, so
+    sketches built with the same accuracy merge by summing.
+    """
+    by = list(by)
+    parts = []
+    for col in columns:
+        x = df[col].to_numpy(dtype='float64')
+        keep = ~np.isnan(x)
+        values = df.loc[keep, by].assign(Column=col, Bucket=_log_bucket(x[keep], accuracy), Sum=x[keep])
+        for dim in by:
+            part = values.groupby([dim, 'Column', 'Bucket'], observed=True, dropna=False).agg(
+                Count=('Sum', 'size'), Sum=('Sum', 'sum')).reset_index()
+            parts.append(part.assign(Dimension=dim))
+    return pd.concat(parts, ignore_index=True)[['Dimension', *by, 'Column', 'Bucket', 'Count', 'Sum']]
+
+
+def merge_sketches(a, b):
+    """Combine two quantile sketches built with the same accuracy"""
+    keys = [c for c in a.columns if c not in ('Count', 'Sum')]
+    merged = pd.concat([a, b], ignore_index=True)
+    return merged.groupby(keys, observed=True, dropna=False)[['Count', 'Sum']].sum().reset_index()
+
+
+def _fold_batches(build, merge, columns, path, cache_dir):
+    return reduce(merge, (build(batch) for batch in iter_batches(path, cache_dir=cache_dir, columns=columns)))
+
+
+def _load_cached(kind, layout, build, merge, columns, path, cache_dir):
+    """Summary of an extract, built on first use and cached next to its Feather copy
+
+    Built one iter_batches() batch at a time and folded with `merge`, so
+    the bookings are never all in memory at once.
+    """
+    if not os.path.isfile(path):
+        return _fold_batches(build, merge, columns, path, cache_dir)
+    digest = hashlib.sha256(repr(layout).encode()).hexdigest()[:12]
+    cached = f"{os.path.splitext(cache_path(path, cache_dir))[0]}.{kind}-{rules_version()}-{digest}.feather"
+    if not os.path.exists(cached):
+        summary = _fold_batches(build, merge, columns, path, cache_dir)
+        write_atomic(pa.Table.from_pandas(summary, preserve_index=False), cached)
+    return feather.read_table(cached).to_pandas()
+
+
+def load_quantile_sketch(path=SOURCE_FILE, cache_dir=CACHE_DIR):
+    """quantile_sketch() for an extract, cached next to its Feather copy"""
+    layout = ('by dimension', SKETCH_DIMENSIONS, SKETCH_COLUMNS, QUANTILE_ACCURACY)
+    return _load_cached('quantiles', layout, quantile_sketch, merge_sketches, SKETCH_DIMENSIONS + SKETCH_COLUMNS,
+                        path, cache_dir)
+
+
+def store_quantile_sketch(store_dir=STORE_DIR, properties=None, periods=None):
+    """quantile_sketch() across the selected store partitions, each sketched once and cached"""
+    key = f"quantiles-by-dimension-{SKETCH_DIMENSIONS}-{SKETCH_COLUMNS}-{QUANTILE_ACCURACY}"
+    return summarise(key, quantile_sketch, merge_sketches, store_dir, properties, periods)
+
+
+def sketch_quantiles(sketch, column, q, by=None):
+    """Approximate quantiles of `column` per group of the `by` dimension (overall when None)
+
+    Each is the mean value of the bucket holding the value of rank
+    q * (n - 1), so it is within the sketch accuracy of that order
+    statistic; pandas would interpolate between neighbouring ranks
+    instead. Returns a Series over `q`, or a DataFrame with a column per q
+    when grouped.
+    """
+    buckets = sketch_values(sketch, column, by)
+    if by is not None:
+        grouped = buckets.groupby(by, observed=True)['Count']
+        cum, total = grouped.cumsum(), grouped.transform('sum')
+    else:
+        cum, total = buckets['Count'].cumsum(), buckets['Count'].sum()
+    out = {}
+    for p in np.atleast_1d(q):
+        hit = buckets[cum > p * (total - 1)]
+        out[p] = hit.groupby(by, observed=True)['Value'].first() if by is not None else hit['Value'].iloc[0]
+    return pd.DataFrame(out) if by is not None else pd.Series(out, name=column)
+
+
+def sketch_values(sketch, column, by=None):
+    """Bucket values and counts of `column` in value order, per group of the `by` dimension when given
+
+    Overall figures are read from any one dimension, as each covers all
+    the bookings.
+    """
+    dim = sketch['Dimension'].iloc[0] if by is None else by
+    rows = sketch[(sketch['Dimension'] == dim) & (sketch['Column'] == column)]
+    keys = ['Bucket'] if by is None else [by, 'Bucket']
+    buckets = rows.groupby(keys, observed=True)[['Count', 'Sum']].sum()
+    return buckets.assign(Value=buckets['Sum'] / buckets['Count']).reset_index()
+
+
+def box_stats(sketch, column, by, groups, whis=1.5):
+    """Box plot statistics per group for matplotlib's Axes.bxp()
+
+    Quartiles come from sketch_quantiles(); whiskers reach the furthest
+    bucket within `whis` IQRs of the box and buckets beyond are fliers.
+    """
+    quartiles = sketch_quantiles(sketch, column, [0.25, 0.5, 0.75], by)
+    buckets = sketch_values(sketch, column, by)
+    stats = []
+    for group in groups:
+        q1, med, q3 = quartiles.loc[group]
+        values = buckets.loc[buckets[by] == group, 'Value'].to_numpy()
+        low, high = q1 - whis * (q3 - q1), q3 + whis * (q3 - q1)
+        inside = values[(values >= low) & (values <= high)]
+        stats.append({'label': group, 'q1': q1, 'med': med, 'q3': q3,
+                      'whislo': inside.min(), 'whishi': inside.max(),
+                      'fliers': values[(values < low) | (values > high)]})
+    return stats
+
+
+def _hll_registers(values, precision):
+    """Register number and rank (leading zeros + 1) of each value's 64-bit hash"""
+    hashed = pd.util.hash_array(np.asarray(values, dtype=object))
+    register = (hashed >> np.uint64(64 - precision)).astype('int64')
+    rest = (hashed & np.uint64((1 << (64 - precision)) - 1)).astype('float64')
+    rank = np.where(rest > 0, (64 - precision) - np.floor(np.log2(np.maximum(rest, 1))), 65 - precision)
+    return register, rank.astype('int8')
+
+
+def distinct_sketch(df, columns=DISTINCT_COLUMNS, by=DISTINCT_DIMENSIONS, precision=HLL_PRECISION):
+    """HyperLogLog registers of each column's values per group of the other `by` dimensions
+
+    Rows are (*by, Column, Register, Rank); the counted column itself is
+    left empty, so a column is never grouped by its own values. Only
+    registers that are set are stored. Merging keeps the highest rank per
+    register, so distinct counts over any union of partitions or segments
+    come from merge_distinct() without the rows.
+    """
+    by = list(by)
+    parts = []
+    for col in columns:
+        keys = [dim for dim in by if dim != col]
+        keep = df[col].notna().to_numpy()
+        register, rank = _hll_registers(df.loc[keep, col], precision)
+        part = df.loc[keep, keys].assign(Column=col, Register=register, Rank=rank)
+        part = part.groupby([*keys, 'Column', 'Register'], observed=True, dropna=False)['Rank'].max()
+        parts.append(part.reset_index())
+    return pd.concat(parts, ignore_index=True)[[*by, 'Column', 'Register', 'Rank']]
+
+
+def merge_distinct(a, b):
+    """Combine two distinct sketches built with the same precision"""
+    keys = [c for c in a.columns if c != 'Rank']
+    merged = pd.concat([a, b], ignore_index=True)
+    return merged.groupby(keys, observed=True, dropna=False)['Rank'].max().reset_index()
+
+
+def load_distinct_sketch(path=SOURCE_FILE, cache_dir=CACHE_DIR):
+    """distinct_sketch() for an extract, cached next to its Feather copy"""
+    layout = ('other dimensions', DISTINCT_DIMENSIONS, DISTINCT_COLUMNS, HLL_PRECISION)
+    columns = list(dict.fromkeys(DISTINCT_DIMENSIONS + DISTINCT_COLUMNS))
+    return _load_cached('distinct', layout, distinct_sketch, merge_distinct, columns, path, cache_dir)
+
+
+def store_distinct_sketch(store_dir=STORE_DIR, properties=None, periods=None):
+    """distinct_sketch() across the selected store partitions, each sketched once and cached"""
+    key = f"distinct-by-other-{DISTINCT_DIMENSIONS}-{DISTINCT_COLUMNS}-{HLL_PRECISION}"
+    return summarise(key, distinct_sketch, merge_distinct, store_dir, properties, periods)
+
+
+def distinct_count(sketch, column, by=None, precision=HLL_PRECISION):
+    """Estimated number of distinct `column` values per `by` group (overall when None)
+
+    HyperLogLog estimate with linear counting while registers are still
+    empty, rounded to a whole count.
+    """
+    by = [] if by is None else [by] if isinstance(by, str) else list(by)
+    registers = sketch[sketch['Column'] == column].groupby([*by, 'Register'], observed=True)['Rank'].max()
+    inverse = np.exp2(-registers.astype('float64'))
+    if by:
+        filled = registers.groupby(level=by, observed=True).size()
+        inverse = inverse.groupby(level=by, observed=True).sum()
+    else:
+        filled, inverse = len(registers), inverse.sum()
+    m = 2 ** precision
+    empty = m - filled
+    raw = 0.7213 / (1 + 1.079 / m) * m * m / (inverse + empty)
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(empty, 1))
+    estimate = np.round(np.where((raw <= 2.5 * m) & (empty > 0), linear, raw)).astype('int64')
+    return pd.Series(estimate, index=filled.index, name=column) if by else int(estimate)
+
+
+def _pairs(columns):
+    return [(a, b) for i, a in enumerate(columns) for b in columns[i:]]
+
+
+def comoments(df, columns=CORRELATION_COLUMNS, by=CORRELATION_DIMENSIONS):
+    """Count, means and co-moment sums of `columns` per `by` group
+
+    One row per group with 'Count', 'Mean <col>' and 'C <a> | <b>', the sum
+    of (a - mean a)(b - mean b), for every pair. Bookings missing any of
+    `columns` are skipped.
+    """
+    columns, by = list(columns), list(by)
+    data = df[by + columns].dropna(subset=columns)
+    keys = [data[b] for b in by]
+    values = data[columns].astype('float64')
+    grouped = values.groupby(keys, observed=True, dropna=False)
+    dev = values - grouped.transform('mean')
+    products = pd.DataFrame({f"C {a} | {b}": dev[a] * dev[b] for a, b in _pairs(columns)})
+    out = grouped.mean().add_prefix('Mean ')
+    out.insert(0, 'Count', grouped.size())
+    return out.join(products.groupby(keys, observed=True, dropna=False).sum()).reset_index()
+
+
+def pool_comoments(cm, by=None, columns=CORRELATION_COLUMNS):
+    """Combine comoments() rows into one per `by` group (a single row when None)
+
+    Co-moments add once each part's deviation of its means from the pooled
+    means is taken into account, so the result equals comoments() over the
+    union of the parts' bookings.
+    """
+    by = [] if by is None else [by] if isinstance(by, str) else list(by)
+    keys = [cm[b] for b in by] or [np.zeros(len(cm), dtype='int8')]
+    n = cm['Count']
+    total = n.groupby(keys, observed=True, dropna=False).transform('sum')
+    means = {c: (cm[f"Mean {c}"] * n).groupby(keys, observed=True, dropna=False).transform('sum') / total
+             for c in columns}
+    dev = {c: cm[f"Mean {c}"] - means[c] for c in columns}
+    parts = pd.DataFrame({'Count': n, **{f"Mean {c}": cm[f"Mean {c}"] * n / total for c in columns}})
+    for a, b in _pairs(columns):
+        parts[f"C {a} | {b}"] = cm[f"C {a} | {b}"] + n * dev[a] * dev[b]
+    pooled = parts.groupby(keys, observed=True, dropna=False).sum()
+    return pooled.reset_index() if by else pooled.reset_index(drop=True)
+
+
+def merge_comoments(a, b):
+    """Combine two comoments() frames with the same groups"""
+    by = list(a.columns[:a.columns.get_loc('Count')])
+    return pool_comoments(pd.concat([a, b], ignore_index=True), by)
+
+
+def pearson(cm, columns=CORRELATION_COLUMNS):
+    """Pearson correlation matrix over all rows of a comoments() frame
+
+    Select segments by filtering rows first, e.g. cm[cm['Has_HB']].
+    """
+    columns = list(columns)
+    pooled = pool_comoments(cm, columns=columns).iloc[0]
+    position = {c: i for i, c in enumerate(columns)}
+    cov = np.empty((len(columns), len(columns)))
+    for a, b in _pairs(columns):
+        cov[position[a], position[b]] = cov[position[b], position[a]] = pooled[f"C {a} | {b}"]
+    scale = np.sqrt(np.diag(cov))
+    return pd.DataFrame(cov / np.outer(scale, scale), index=columns, columns=columns)
+
+
+def rank_sketch(df, columns=CORRELATION_COLUMNS, by=CORRELATION_DIMENSIONS, accuracy=QUANTILE_ACCURACY):
+    """Joint log-bucket counts of `columns` per `by` group, for rank correlations
+
+    One row per group and combination of the columns' quantile_sketch()
+    buckets, with its Count; merge with merge_rank_sketches().
+    """
+    columns, by = list(columns), list(by)
+    data = df[by + columns].dropna(subset=columns)
+    buckets = data[by].assign(**{f"Bucket {c}": _log_bucket(data[c].to_numpy(dtype='float64'), accuracy)
+                                 for c in columns})
+    return buckets.groupby(list(buckets.columns), observed=True, dropna=False).size().rename('Count').reset_index()
+
+
+def merge_rank_sketches(a, b):
+    """Combine two rank sketches built with the same accuracy"""
+    keys = [c for c in a.columns if c != 'Count']
+    merged = pd.concat([a, b], ignore_index=True)
+    return merged.groupby(keys, observed=True, dropna=False)['Count'].sum().reset_index()
+
+
+def spearman(rs, columns=CORRELATION_COLUMNS):
+    """Approximate Spearman correlation matrix over all rows of a rank_sketch()
+
+    Every booking in a bucket gets the bucket's mid-rank, so values closer
+    than the bucket width count as ties.
+    """
+    weights = rs['Count'].to_numpy(dtype='float64')
+    ranks = []
+    for c in columns:
+        counts = rs.groupby(f"Bucket {c}")['Count'].sum()
+        mid = counts.cumsum() - (counts - 1) / 2
+        ranks.append(rs[f"Bucket {c}"].map(mid).to_numpy(dtype='float64'))
+    cov = np.cov(ranks, aweights=weights)
+    scale = np.sqrt(np.diag(cov))
+    return pd.DataFrame(cov / np.outer(scale, scale), index=columns, columns=columns)
+
+
+def load_comoments(path=SOURCE_FILE, cache_dir=CACHE_DIR):
+    """comoments() for an extract, cached next to its Feather copy"""
+    return _load_cached('comoments', (CORRELATION_DIMENSIONS, CORRELATION_COLUMNS), comoments, merge_comoments,
+                        CORRELATION_DIMENSIONS + CORRELATION_COLUMNS, path, cache_dir)
+
+
+def load_rank_sketch(path=SOURCE_FILE, cache_dir=CACHE_DIR):
+    """rank_sketch() for an extract, cached next to its Feather copy"""
+    return _load_cached('ranks', (CORRELATION_DIMENSIONS, CORRELATION_COLUMNS, QUANTILE_ACCURACY), rank_sketch,
+                        merge_rank_sketches, CORRELATION_DIMENSIONS + CORRELATION_COLUMNS, path, cache_dir)
+
+
+def store_comoments(store_dir=STORE_DIR, properties=None, periods=None):
+    """comoments() across the selected store partitions, each summarised once and cached"""
+    return summarise(f"comoments-{CORRELATION_DIMENSIONS}-{CORRELATION_COLUMNS}", comoments, merge_comoments,
+                     store_dir, properties, periods)
+
+
+def store_rank_sketch(store_dir=STORE_DIR, properties=None, periods=None):
+    """rank_sketch() across the selected store partitions, each sketched once and cached"""
+    return summarise(f"ranks-{CORRELATION_DIMENSIONS}-{CORRELATION_COLUMNS}-{QUANTILE_ACCURACY}", rank_sketch,
+                     merge_rank_sketches, store_dir, properties, periods)
@@ -0,0 +1,357 @@
+import argparse
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import pandas as pd
+from scipy import stats
+from hb_data import load_bookings
+from hb_metrics import HB_NIGHT_VALUE, TARGET_HB_PCT, opportunity_scores, top_k
+
+# Uncertainty around the report's point estimates. Random draws come from
+# seeds spawned per batch, so results do not depend on the process count.
+
+# Draws for the uplift simulation, as (numpy Generator method, keyword
+# arguments). conversion is the share of an agency's gap to target actually
+# won; night_value the AED earned per converted HB night. The opportunity
+# matrix's own figure is full conversion at HB_NIGHT_VALUE, so these bands
+# sit below it.
+UPLIFT_DISTRIBUTIONS = {
+    'conversion': ('beta', {'a': 2, 'b': 2}),
+    'night_value': ('triangular', {'left': 90, 'mode': HB_NIGHT_VALUE, 'right': 150}),
+}
+
+# Weight of a hotel-wide component in every draw. Each agency's value is
+# w x (one draw per trial, shared by all agencies) + (1 - w) x (its own
+# draw), which keeps the mean and correlates agencies through the sales push
+# and the HB supplement they share. 0 draws agencies independently.
+UPLIFT_SHARED_WEIGHT = 0.0
+
+UPLIFT_PERCENTILES = [10, 50, 90]
+
+# Trials drawn per batch; only the per-trial totals leave a batch
+BATCH_TRIALS = 2000
+
+BOOTSTRAP_STATISTICS = ['HB Penetration %', 'HB Revenue Share %', 'HB Rate Premium (AED)']
+
+# Bootstrap draws held at once per batch, resamples x bookings
+BOOTSTRAP_CELLS = 4_000_000
+
+# Groups with fewer HB or non-HB bookings than this fall back from Welch's
+# t-test to a permutation test (rates) and from the z-test to Fisher's
+# exact test (penetration)
+SMALL_GROUP = 10
+TEST_PERMUTATIONS = 10000
+
+# Small groups handed to each permutation task, and permutations drawn at once
+PERMUTATION_GROUPS = 64
+PERMUTATION_CHUNK = 100_000
+
+TEST_COLUMNS = ['Dimension', 'Group', 'Test', 'Method', 'HB Bookings', 'Other Bookings', 'Effect',
+                'Statistic', 'P-Value', 'Adjusted P-Value', 'Significant']
+
+
+def _check_distributions(distributions):
+    if set(distributions) != set(UPLIFT_DISTRIBUTIONS):
+        raise ValueError(f"uplift distributions must cover {sorted(UPLIFT_DISTRIBUTIONS)}, got {sorted(distributions)}")
+    for name, (method, _) in distributions.items():
+        if not callable(getattr(np.random.Generator, method, None)):
+            raise ValueError(f"unknown distribution {method!r} for {name}")
+
+
+def _simulate_batch(gap_nights, distributions, shared_weight, trials, seed):
+    """Uplift factor for one agency and total uplift in AED for one batch, each shape (trials,)"""
+    rng = np.random.default_rng(seed)
+    draws = {}
+    for name, (method, params) in distributions.items():
+        draws[name] = getattr(rng, method)(size=(trials, len(gap_nights)), **params)
+        if shared_weight:
+            hotel = getattr(rng, method)(size=(trials, 1), **params)
+            draws[name] = shared_weight * hotel + (1 - shared_weight) * draws[name]
+    factor = draws['conversion'] * draws['night_value']
+    return factor[:, 0], factor @ gap_nights
+
+
+def simulate_uplift(df, trials=20000, target_pct=TARGET_HB_PCT, distributions=UPLIFT_DISTRIBUTIONS,
+                    by='Search Name', seed=0, processes=None, shared_weight=UPLIFT_SHARED_WEIGHT):
+    """Monte Carlo range for the incremental F&B revenue of the opportunity matrix
+
+    Each trial draws a conversion rate and a night value per agency from
+    `distributions`, mixed with a hotel-wide draw by `shared_weight`, and
+    prices the converted part of each agency's gap to `target_pct`. Trials
+    run in batches of BATCH_TRIALS, spread over a process pool unless
+    `processes` is 1. Returns the per-agency percentiles, with the
+    full-conversion figure alongside, and the same percentiles of the total
+    across agencies. With no agencies to score the first is empty and the
+    total is zero.
+
+    Every agency's draws follow the same distribution, so its percentiles
+    are its gap times the percentiles of one agency's factor; only that
+    sample and the per-trial totals leave a batch.
+    """
+    _check_distributions(distributions)
+    if not 0 <= shared_weight <= 1:
+        raise ValueError(f"shared_weight must be between 0 and 1, got {shared_weight}")
+    opportunity = opportunity_scores(df, by, target_pct)
+    gap_nights = opportunity['Potential HB Nights'].to_numpy(dtype='float64')
+    labels = [f"P{p} (AED)" for p in UPLIFT_PERCENTILES]
+
+    if len(gap_nights):
+        sizes = [BATCH_TRIALS] * (trials // BATCH_TRIALS) + ([trials % BATCH_TRIALS] if trials % BATCH_TRIALS else [])
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        args = (repeat(gap_nights), repeat(distributions), repeat(shared_weight), sizes, seeds)
+        if len(sizes) == 1 or processes == 1:
+            batches = list(map(_simulate_batch, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                batches = list(pool.map(_simulate_batch, *args))
+        factor = np.percentile(np.concatenate([batch[0] for batch in batches]), UPLIFT_PERCENTILES)
+        total = np.percentile(np.concatenate([batch[1] for batch in batches]), UPLIFT_PERCENTILES)
+    else:
+        factor, total = np.zeros(len(labels)), np.zeros(len(labels))
+
+    agencies = pd.DataFrame(np.outer(gap_nights, factor), index=opportunity.index, columns=labels)
+    agencies.insert(0, 'Full Conversion (AED)', opportunity['Est. Incremental F&B Revenue (AED)'])
+    agencies.insert(0, 'Potential HB Nights', opportunity['Potential HB Nights'])
+    return agencies, pd.Series(total, index=labels)
+
+
+def _booking_sums(df):
+    """Per-booking terms whose group sums give the BOOTSTRAP_STATISTICS"""
+    hb = df['Has_HB'].to_numpy(dtype='float64')
+    revenue = df['Room Revenue'].to_numpy(dtype='float64')
+    rate = df['Avg_Rate_Per_Night'].to_numpy(dtype='float64')
+    rated = ~np.isnan(rate)
+    rate = np.where(rated, rate, 0.0)
+    return [hb, revenue, revenue * hb, rated * hb, rate * hb, rated * (1 - hb), rate * (1 - hb)]
+
+
+def _interval_statistics(sums, sizes):
+    """BOOTSTRAP_STATISTICS from summed booking terms, NaN where undefined"""
+    hb, revenue, hb_revenue, rated_hb, rate_hb, rated_other, rate_other = sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.stack([
+            hb / sizes * 100,
+            np.where(revenue != 0, hb_revenue / revenue * 100, np.nan),
+            rate_hb / rated_hb - rate_other / rated_other,
+        ])
+
+
+def _bootstrap_batch(values, starts, sizes, resamples, seed):
+    """Statistics for one batch of resamples, shape (statistics, resamples, groups)
+
+    One index matrix draws every group's bookings with replacement from
+    within that group; `values` are sorted by group, so group sums are a
+    reduceat over contiguous columns.
+    """
+    rng = np.random.default_rng(seed)
+    idx = np.repeat(starts, sizes) + rng.integers(0, np.repeat(sizes, sizes), size=(resamples, sizes.sum()))
+    return _interval_statistics([np.add.reduceat(v[idx], starts, axis=1) for v in values], sizes)
+
+
+def bootstrap_intervals(df, by=None, resamples=10000, confidence=0.95, seed=0, processes=None):
+    """Bootstrap confidence intervals for HB penetration, revenue share and rate premium
+
+    Bookings are resampled within each `by` group (the whole table when
+    `by` is None), all groups at once, in batches of about BOOTSTRAP_CELLS
+    draws spread over a process pool unless `processes` is 1. The rate
+    premium is the HB minus non-HB mean Avg_Rate_Per_Night and is NaN for
+    groups without both. Returns the point value and percentile interval
+    of each statistic per group, with the group's Bookings.
+    """
+    if by is None:
+        codes, labels = np.zeros(len(df), dtype='int64'), pd.Index(['All'])
+    else:
+        grouped = df.groupby(by, observed=True)
+        codes, labels = grouped.ngroup().fillna(-1).to_numpy(dtype='int64'), grouped.size().index
+    order = np.argsort(codes, kind='stable')
+    order = order[codes[order] >= 0]
+    sizes = np.bincount(codes[order], minlength=len(labels))
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    values = [v[order] for v in _booking_sums(df)]
+
+    per_batch = max(1, BOOTSTRAP_CELLS // max(len(order), 1))
+    batches = [per_batch] * (resamples // per_batch) + ([resamples % per_batch] if resamples % per_batch else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    args = (repeat(values), repeat(starts), repeat(sizes), batches, seeds)
+    if len(batches) == 1 or processes == 1:
+        draws = list(map(_bootstrap_batch, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            draws = list(pool.map(_bootstrap_batch, *args))
+    draws = np.concatenate(draws, axis=1)
+
+    alpha = (1 - confidence) / 2 * 100
+    with warnings.catch_warnings():
+        # Groups without HB or non-HB bookings have no premium
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low, high = np.nanpercentile(draws, [alpha, 100 - alpha], axis=1)
+    point = _interval_statistics([np.add.reduceat(v, starts) for v in values], sizes)
+
+    out = pd.DataFrame({'Bookings': sizes}, index=labels)
+    for i, name in enumerate(BOOTSTRAP_STATISTICS):
+        out[name] = point[i]
+        out[f"{name} Low"] = low[i]
+        out[f"{name} High"] = high[i]
+    return out
+
+
+def _floyd_sample(rng, n, k, size):
+    """`size` independent uniform k-subsets of range(n), shape (size, k), by Floyd's algorithm"""
+    chosen = np.empty((size, k), dtype='int64')
+    for i, j in enumerate(range(n - k, n)):
+        t = rng.integers(0, j + 1, size=size)
+        # A value already taken is replaced by j, which no earlier step could draw
+        chosen[:, i] = np.where((chosen[:, :i] == t[:, None]).any(axis=1), j, t)
+    return chosen
+
+
+def _permutation_batch(groups, permutations, seed):
+    """Two-sided permutation p-values for the HB minus non-HB mean rate of each group
+
+    Each permutation draws only the positions of the smaller side, so
+    memory is PERMUTATION_CHUNK x min(HB, non-HB bookings) however large
+    the group is.
+    """
+    rng = np.random.default_rng(seed)
+    p_values = []
+    for rates, hb in groups:
+        n, n_hb = len(rates), int(hb.sum())
+        k, total = min(n_hb, n - n_hb), rates.sum()
+        observed = abs(rates[hb].mean() - rates[~hb].mean())
+        extreme = 0
+        for start in range(0, permutations, PERMUTATION_CHUNK):
+            size = min(PERMUTATION_CHUNK, permutations - start)
+            side = rates[_floyd_sample(rng, n, k, size)].sum(axis=1)
+            hb_sum = side if k == n_hb else total - side
+            diff = hb_sum / n_hb - (total - hb_sum) / (n - n_hb)
+            extreme += np.count_nonzero(np.abs(diff) >= observed * (1 - 1e-9))
+        p_values.append((extreme + 1) / (permutations + 1))
+    return p_values
+
+
+def _rate_tests(df, by, permutations, seed, processes):
+    """HB vs non-HB Avg_Rate_Per_Night within each group"""
+    rated = df[[by, 'Has_HB', 'Avg_Rate_Per_Night']].dropna()
+    moments = rated.groupby([by, 'Has_HB'], observed=True)['Avg_Rate_Per_Night'].agg(['count', 'mean', 'var'])
+    # Reindex so a frame with no HB, or no non-HB, bookings gives an empty table
+    moments = moments.unstack('Has_HB').reindex(columns=pd.MultiIndex.from_product([moments.columns, [False, True]]))
+    moments = moments.dropna(subset=[('count', True), ('count', False)])
+    n1, n0 = moments[('count', True)].to_numpy(dtype='int64'), moments[('count', False)].to_numpy(dtype='int64')
+    m1, m0 = moments[('mean', True)].to_numpy(), moments[('mean', False)].to_numpy()
+    v1, v0 = moments[('var', True)].to_numpy(), moments[('var', False)].to_numpy()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        se2 = v1 / n1 + v0 / n0
+        t = (m1 - m0) / np.sqrt(se2)
+        dof = se2 ** 2 / ((v1 / n1) ** 2 / (n1 - 1) + (v0 / n0) ** 2 / (n0 - 1))
+        p = 2 * stats.t.sf(np.abs(t), dof)
+    small = (n1 < SMALL_GROUP) | (n0 < SMALL_GROUP)
+    t[small] = np.nan
+
+    if small.any():
+        keys = set(moments.index[small])
+        groups = [(g['Avg_Rate_Per_Night'].to_numpy(dtype='float64'), g['Has_HB'].to_numpy())
+                  for key, g in rated[rated[by].isin(keys)].groupby(by, observed=True)]
+        chunks = [groups[i:i + PERMUTATION_GROUPS] for i in range(0, len(groups), PERMUTATION_GROUPS)]
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+        args = (chunks, repeat(permutations), seeds)
+        if len(chunks) == 1 or processes == 1:
+            results = list(map(_permutation_batch, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                results = list(pool.map(_permutation_batch, *args))
+        # groupby and moments share the sorted group order
+        p[small] = np.concatenate(results)
+
+    return pd.DataFrame({
+        'Group': moments.index,
+        'Test': 'HB Rate Difference',
+        'Method': np.where(small, 'Permutation', 'Welch t-test'),
+        'HB Bookings': n1,
+        'Other Bookings': n0,
+        'Effect': m1 - m0,
+        'Statistic': t,
+        'P-Value': p,
+    })
+
+
+def _penetration_tests(df, by):
+    """HB penetration of each group against all other bookings"""
+    counts = df.groupby(by, observed=True)['Has_HB'].agg(['size', 'sum'])
+    total, total_hb = len(df), int(df['Has_HB'].sum())
+    n, a = counts['size'].to_numpy(), counts['sum'].to_numpy()
+    counts, n, a = counts[n < total], n[n < total], a[n < total]
+    rest, rest_hb = total - n, total_hb - a
+
+    # An empty frame leaves no groups to test
+    pooled = total_hb / total if total else 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (a / n - rest_hb / rest) / np.sqrt(pooled * (1 - pooled) * (1 / n + 1 / rest))
+    p = 2 * stats.norm.sf(np.abs(z))
+    small = (a < SMALL_GROUP) | (n - a < SMALL_GROUP)
+    z[small] = np.nan
+    for i in np.flatnonzero(small):
+        p[i] = stats.fisher_exact([[a[i], n[i] - a[i]], [rest_hb[i], rest[i] - rest_hb[i]]]).pvalue
+
+    return pd.DataFrame({
+        'Group': counts.index,
+        'Test': 'HB Penetration vs Rest',
+        'Method': np.where(small, 'Fisher exact', 'Two-proportion z-test'),
+        'HB Bookings': a,
+        'Other Bookings': n - a,
+        'Effect': (a / n - rest_hb / rest) * 100,
+        'Statistic': z,
+        'P-Value': p,
+    })
+
+
+def hb_tests(df, dimensions=('Search Name', 'Rate Code'), alpha=0.05, permutations=TEST_PERMUTATIONS,
+             seed=0, processes=None):
+    """HB rate and penetration tests for every group of each dimension, as one tidy table
+
+    Rate tests compare HB with non-HB Avg_Rate_Per_Night inside a group
+    (Effect in AED); penetration tests compare a group's HB share of
+    bookings with all other bookings (Effect in percentage points). Both
+    statistics are computed for all groups at once from grouped moments and
+    counts; groups below SMALL_GROUP use the exact fallbacks, with the
+    permutation tests spread over a process pool unless `processes` is 1.
+    P-values get a Benjamini-Hochberg correction within each dimension and
+    test, and Significant compares the adjusted value with `alpha`.
+    """
+    tables = []
+    for dim in dimensions:
+        for table in [_rate_tests(df, dim, permutations, seed, processes), _penetration_tests(df, dim)]:
+            table.insert(0, 'Dimension', dim)
+            tested = table['P-Value'].notna()
+            table['Adjusted P-Value'] = np.nan
+            if tested.any():
+                table.loc[tested, 'Adjusted P-Value'] = stats.false_discovery_control(table.loc[tested, 'P-Value'])
+            table['Significant'] = table['Adjusted P-Value'] < alpha
+            tables.append(table)
+    return pd.concat(tables, ignore_index=True)[TEST_COLUMNS]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate the range of incremental HB revenue per agency')
+    parser.add_argument('--trials', type=int, default=20000, help='number of Monte Carlo trials')
+    parser.add_argument('--target', type=float, default=TARGET_HB_PCT, help='HB share target, %%')
+    parser.add_argument('--shared-weight', type=float, default=UPLIFT_SHARED_WEIGHT,
+                        help='weight of the hotel-wide draw, 0 (independent agencies) to 1')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--processes', type=int, help='worker processes, default one per CPU')
+    parser.add_argument('--top', type=int, default=15, help='agencies to list')
+    args = parser.parse_args()
+    if args.trials < 1:
+        parser.error('--trials must be positive')
+    df = load_bookings(columns=['Search Name', 'Room Nights', 'Has_HB'])
+    try:
+        agencies, total = simulate_uplift(df, args.trials, args.target, seed=args.seed, processes=args.processes,
+                                          shared_weight=args.shared_weight)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Incremental F&B revenue over {args.trials:,} trials at a {args.target:g}% HB target, "
+          f"with part of each gap converted")
+    print(top_k(agencies, args.top, 'P50 (AED)').map(lambda v: f"{v:,.0f}").to_string())
+    print(f"Total: full conversion {agencies['Full Conversion (AED)'].sum():,.0f}, "
+          + ', '.join(f"{label} {value:,.0f}" for label, value in total.items()))
@@ -0,0 +1,206 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+from datetime import datetime
+from functools import reduce
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from hb_data import (SOURCE_DIR, apply_schema, derive_columns, file_hash, read_extract, rules_version,
+                     validate_bookings, write_atomic)
+
+# Append-only booking history, one partition per property and month:
+#   hb_store/property=<name>/period=<YYYY-MM>/bookings.feather
+# next to the source unless HB_STORE_DIR names another folder
+STORE_DIR = os.environ.get('HB_STORE_DIR', os.path.join(SOURCE_DIR, 'hb_store'))
+MANIFEST_FILE = 'manifest.json'
+PARTITION_FILE = 'bookings.feather'
+QUARANTINE_FILE = 'quarantine.feather'
+
+PERIOD_FORMAT = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+
+# Additive measures kept per partition; ratios are computed after combining
+MEASURES = ['Bookings', 'Room Nights', 'Room Revenue', 'HB Bookings', 'HB Room Nights', 'HB Revenue (AED)']
+
+
+def read_manifest(store_dir=STORE_DIR):
+    """Return the store manifest, empty if nothing has been ingested yet"""
+    path = os.path.join(store_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {'partitions': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest, store_dir):
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, MANIFEST_FILE)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def partition_dir(prop, period, store_dir=STORE_DIR):
+    """Directory holding the partition for one property and month"""
+    return os.path.join(store_dir, f"property={prop}", f"period={period}")
+
+
+def ingest(path, period, prop, store_dir=STORE_DIR, replace=False):
+    """Add an extract to the store as the partition for (`prop`, `period`)
+
+    Loading the same file twice is a no-op. A different file for a partition
+    that already exists is refused unless `replace` is set, e.g. for an
+    amended month. Returns True when the store changed.
+    """
+    if not PERIOD_FORMAT.match(period):
+        raise ValueError(f"period must look like YYYY-MM, got {period!r}")
+    if not prop or '/' in prop or os.sep in prop:
+        raise ValueError(f"invalid property name {prop!r}")
+
+    digest = file_hash(path)
+    manifest = read_manifest(store_dir)
+    key = f"{prop}/{period}"
+    existing = manifest['partitions'].get(key)
+    if existing is not None:
+        if existing['source_hash'] == digest:
+            return False
+        if not replace:
+            raise ValueError(f"partition {key} is already loaded from {existing['source']}; "
+                             f"pass replace=True to load an amended extract")
+
+    df, quarantined = validate_bookings(read_extract(path))
+    target_dir = partition_dir(prop, period, store_dir)
+    # Dropping the directory also drops aggregates cached for the old data
+    shutil.rmtree(target_dir, ignore_errors=True)
+    write_atomic(pa.Table.from_pandas(quarantined, preserve_index=False), os.path.join(target_dir, QUARANTINE_FILE))
+    write_atomic(pa.Table.from_pandas(df, preserve_index=False), os.path.join(target_dir, PARTITION_FILE))
+
+    manifest['partitions'][key] = {
+        'property': prop,
+        'period': period,
+        'source': os.path.abspath(path),
+        'source_hash': digest,
+        'rows': len(df),
+        'quarantined': {reason: int(n) for reason, n in quarantined['Reason'].value_counts().items() if n},
+        'ingested_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    _write_manifest(manifest, store_dir)
+    return True
+
+
+def list_partitions(store_dir=STORE_DIR, properties=None, periods=None):
+    """Manifest entries for the selected partitions, ordered by property and period"""
+    entries = sorted(read_manifest(store_dir)['partitions'].values(),
+                     key=lambda e: (e['property'], e['period']))
+    if properties is not None:
+        entries = [e for e in entries if e['property'] in properties]
+    if periods is not None:
+        entries = [e for e in entries if e['period'] in periods]
+    return entries
+
+
+def read_partition(entry, store_dir=STORE_DIR, derived=True):
+    """Load one partition, tagged with its Property and Period"""
+    path = os.path.join(partition_dir(entry['property'], entry['period'], store_dir), PARTITION_FILE)
+    df = feather.read_table(path, memory_map=True).to_pandas()
+    if derived:
+        df = pd.concat([df, derive_columns(df)], axis=1)
+    df['Property'] = entry['property']
+    df['Period'] = entry['period']
+    return df
+
+
+def load_store(store_dir=STORE_DIR, properties=None, periods=None, derived=True):
+    """Load the selected partitions as one DataFrame in the shared schema"""
+    frames = [read_partition(e, store_dir, derived) for e in list_partitions(store_dir, properties, periods)]
+    if not frames:
+        raise ValueError(f"no partitions selected in {store_dir}")
+    df = apply_schema(pd.concat(frames, ignore_index=True))
+    return df.astype({'Property': 'category', 'Period': 'category'})
+
+
+def partial_aggregate(df, by):
+    """Sum the additive MEASURES of a booking frame grouped by `by`"""
+    df = df.assign(
+        _hb_nights=df['Room Nights'].where(df['Has_HB'], 0),
+        _hb_revenue=df['Room Revenue'].where(df['Has_HB'], 0.0),
+    )
+    return df.groupby(by, observed=True).agg(**{
+        'Bookings': ('Room Nights', 'size'),
+        'Room Nights': ('Room Nights', 'sum'),
+        'Room Revenue': ('Room Revenue', 'sum'),
+        'HB Bookings': ('Has_HB', 'sum'),
+        'HB Room Nights': ('_hb_nights', 'sum'),
+        'HB Revenue (AED)': ('_hb_revenue', 'sum'),
+    })
+
+
+def aggregate(by, store_dir=STORE_DIR, properties=None, periods=None):
+    """Additive measures grouped by `by` across the selected partitions
+
+    Each partition's result is cached inside the partition, so after a
+    monthly load only the new or replaced partitions are scanned.
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    key = hashlib.sha256(repr((by, rules_version())).encode()).hexdigest()[:12]
+    partials = []
+    for entry in list_partitions(store_dir, properties, periods):
+        cached = os.path.join(partition_dir(entry['property'], entry['period'], store_dir), f"agg-{key}.feather")
+        if not os.path.exists(cached):
+            part = partial_aggregate(read_partition(entry, store_dir), by).reset_index()
+            write_atomic(pa.Table.from_pandas(part, preserve_index=False), cached)
+        partials.append(feather.read_table(cached).to_pandas())
+    if not partials:
+        raise ValueError(f"no partitions selected in {store_dir}")
+    return pd.concat(partials, ignore_index=True).groupby(by, observed=True)[MEASURES].sum()
+
+
+def summarise(name, build, merge, store_dir=STORE_DIR, properties=None, periods=None):
+    """Fold a mergeable summary over the selected partitions
+
+    `build` turns one partition's bookings into a summary DataFrame and
+    `merge` combines two summaries. Summaries are cached inside each
+    partition under `name`, which must change whenever `build` does.
+    """
+    key = hashlib.sha256(repr((name, rules_version())).encode()).hexdigest()[:12]
+    summaries = []
+    for entry in list_partitions(store_dir, properties, periods):
+        cached = os.path.join(partition_dir(entry['property'], entry['period'], store_dir), f"summary-{key}.feather")
+        if not os.path.exists(cached):
+            write_atomic(pa.Table.from_pandas(build(read_partition(entry, store_dir))), cached)
+        summaries.append(feather.read_table(cached).to_pandas())
+    if not summaries:
+        raise ValueError(f"no partitions selected in {store_dir}")
+    return reduce(merge, summaries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the partitioned Half Board booking store')
+    parser.add_argument('--store', default=STORE_DIR, help='store directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ingest_cmd = commands.add_parser('ingest', help='append a monthly extract as a new partition')
+    ingest_cmd.add_argument('path', help='xlsx or csv extract')
+    ingest_cmd.add_argument('--period', required=True, help='month covered by the extract, YYYY-MM')
+    ingest_cmd.add_argument('--property', required=True, help='hotel the extract belongs to')
+    ingest_cmd.add_argument('--replace', action='store_true', help='overwrite an existing partition')
+
+    commands.add_parser('list', help='show loaded partitions')
+
+    args = parser.parse_args()
+    if args.command == 'ingest':
+        try:
+            changed = ingest(args.path, args.period, args.property, args.store, args.replace)
+        except ValueError as e:
+            parser.error(str(e))
+        key = f"{args.property}/{args.period}"
+        print(f"Loaded partition {key}" if changed else f"Partition {key} already up to date")
+    else:
+        for entry in list_partitions(args.store):
+            held = sum(entry.get('quarantined', {}).values())
+            print(f"{entry['property']:<30} {entry['period']}  {entry['rows']:>10,} rows  "
+                  f"{held:>6,} quarantined  {entry['source']}")